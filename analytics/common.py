@@ -0,0 +1,31 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+# Helpers shared by the analytics scripts.
+
+import datetime
+import json
+import os
+
+
+def write_json(path, data):
+    '''Writes a JSON file atomically: under a temporary name, then renamed, so that readers never see a partial file.'''
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def year_months(start_ts, end_ts, tz):
+    '''Returns the "YYYYMM" GSI hash keys of the months from start_ts to end_ts, in the timezone Image Processor uses.'''
+    month = datetime.datetime.fromtimestamp(start_ts, tz).replace(day=1)
+    last = datetime.datetime.fromtimestamp(end_ts, tz).strftime("%Y%m")
+
+    keys = []
+    while True:
+        keys.append(month.strftime("%Y%m"))
+        if keys[-1] >= last:
+            return keys
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
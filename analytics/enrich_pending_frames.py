@@ -0,0 +1,241 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+function_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "imageprocessor")
+sys.path.insert(0, function_dir)
+import detectors
+import imageprocessor
+import watchlist
+
+#Enrichment parameters
+default_gsi_name = "pending_year_month-processed_timestamp-index"
+default_months = 1
+default_concurrency = 4
+report_interval_frames = 100
+window_frames_per_thread = 8 #frames in flight per thread. Bounds memory, whatever the backlog.
+
+thread_local = threading.local()
+
+
+def thread_tables(config):
+    '''Frame, label index, and rollup tables of the calling thread.
+
+    boto3 resources are not thread-safe, so every thread gets its own, from its own session.
+    '''
+    if not hasattr(thread_local, 'tables'):
+        dynamodb = boto3.session.Session().resource('dynamodb')
+        thread_local.tables = tuple(dynamodb.Table(config[name]) for name in ("ddb_table", "ddb_label_index_table", "ddb_rollup_table"))
+    return thread_local.tables
+
+
+def pending_year_months(month_count, config):
+    '''Returns the "YYYYMM" pending GSI hash keys of the last month_count months, oldest first, in Image Processor's timezone.'''
+    month = imageprocessor.convert_ts(time.time(), config).replace(day=1)
+
+    keys = []
+    for _ in range(month_count):
+        keys.insert(0, month.strftime("%Y%m"))
+        month = (month - datetime.timedelta(days=1)).replace(day=1)
+    return keys
+
+
+def query_pending_frame_ids(ddb_table, gsi_name, year_month):
+    '''Yields the ids of one month's frames still flagged enrichment_pending, oldest first.
+
+    The GSI is sparse: Image Processor only sets its hash key on frames it stored without labels, and
+    enrichment removes it. So the query reads pending frames only, never the whole month.
+    '''
+    query_kwargs = {
+        'IndexName': gsi_name,
+        'KeyConditionExpression': Key('pending_year_month').eq(year_month),
+        'ScanIndexForward': True
+    }
+
+    while True:
+        ddb_resp = ddb_table.query(**query_kwargs)
+
+        for item in ddb_resp['Items']:
+            yield item['frame_id']
+
+        if 'LastEvaluatedKey' not in ddb_resp:
+            return
+        query_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+
+def read_frame_image(s3_client, item):
+    '''Reads a frame's JPEG bytes, from its hourly archive with a ranged GET if Frame Compactor packed it.'''
+    if 'archive_s3_key' in item:
+        first_byte = int(item['archive_offset'])
+        last_byte = first_byte + int(item['archive_length']) - 1
+        response = s3_client.get_object(Bucket=item['s3_bucket'], Key=item['archive_s3_key'],
+            Range='bytes={}-{}'.format(first_byte, last_byte))
+    else:
+        response = s3_client.get_object(Bucket=item['s3_bucket'], Key=item['s3_key'])
+
+    return response['Body'].read()
+
+
+def enrich_frame(frame_id, detector, watch_list, config, s3_client):
+    '''Labels one pending frame, and indexes and counts its labels like Image Processor would have.
+
+    Returns the number of labels found, or None if the frame was no longer pending. Watch List alerts
+    are not sent, since the frame is old news by now; its labels are still flagged OnWatchList.
+
+    The frame gets an enriched_timestamp, so that the incremental export (analytics/export_frames.py),
+    which has already passed the frame's processed_timestamp, picks up its new labels.
+    '''
+    ddb_table, label_index_table, rollup_table = thread_tables(config)
+
+    item = ddb_table.get_item(Key={'frame_id': frame_id}).get('Item')
+    if not item or 'pending_year_month' not in item:
+        return None
+
+    rekog_response = detector.detect(read_frame_image(s3_client, item))
+
+    for label in rekog_response['Labels']:
+        label['OnWatchList'] = watch_list.matches(label)
+
+    #Convert from float to decimal for DynamoDB
+    labels = json.loads(json.dumps(rekog_response['Labels']), parse_float=Decimal)
+
+    now_ts = time.time()
+
+    #Conditional, so that a frame enriched concurrently (e.g. by an overlapping run) is only counted once
+    try:
+        ddb_table.update_item(
+            Key={'frame_id': frame_id},
+            UpdateExpression='SET rekog_labels = :labels, detector = :detector, enriched_timestamp = :ts, enriched_year_month = :ym '
+                'REMOVE enrichment_pending, pending_year_month',
+            ConditionExpression='attribute_exists(pending_year_month)',
+            ExpressionAttributeValues={
+                ':labels': labels,
+                ':detector': rekog_response['Detector'],
+                ':ts': Decimal(repr(now_ts)),
+                ':ym': imageprocessor.convert_ts(now_ts, config).strftime("%Y%m") #Hash Key of the sparse GSI of enriched frames
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+
+    processed_ts = float(item['processed_timestamp'])
+    with label_index_table.batch_writer(overwrite_by_pkeys=['label_bucket', 'conf_frame']) as batch:
+        for label in labels:
+            batch.put_item(Item={
+                'label_bucket': imageprocessor.label_bucket(label['Name'], processed_ts),
+                'conf_frame': '{:06.2f}#{}'.format(label['Confidence'], frame_id),
+                'label': label['Name'],
+                'confidence': label['Confidence'],
+                'frame_id': frame_id,
+                'processed_timestamp': item['processed_timestamp']
+            })
+
+    for label in labels:
+        for cam in (item.get('camera_id', 'default'), '*'):
+            for granularity, bucket_ts in imageprocessor.rollup_buckets(float(item['approx_capture_timestamp'])):
+                rollup_table.update_item(
+                    Key={'rollup_key': '{}#{}#{}'.format(label['Name'].upper(), cam, granularity), 'bucket_ts': bucket_ts},
+                    UpdateExpression='ADD frame_count :f, instance_count :i',
+                    ExpressionAttributeValues={':f': 1, ':i': len(label.get('Instances', []))}
+                )
+
+    return len(labels)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Label frames that Image Processor stored without labels while shedding load.")
+    parser.add_argument("--params", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config", "imageprocessor-params.json"),
+        help="Image Processor parameters file. Tables, detector and Watch List settings are read from it.")
+    parser.add_argument("--gsi-name", default=default_gsi_name,
+        help="name of the frame table's sparse GSI on pending_year_month. Default is '{}'.".format(default_gsi_name))
+    parser.add_argument("--months", type=int, default=default_months,
+        help="enrich pending frames processed in the last X calendar months, this one included. Default is {}.".format(default_months))
+    parser.add_argument("--max-frames", type=int, default=0,
+        help="stop after X frames, e.g. to bound Amazon Rekognition cost. Default is 0, no limit.")
+    parser.add_argument("--concurrency", type=int, default=default_concurrency,
+        help="frames labeled concurrently, with the rekognition backend. Default is {}.".format(default_concurrency))
+
+    args = parser.parse_args()
+
+    with open(args.params, "r") as params_file:
+        config = json.load(params_file)
+
+    #Model paths in the parameters file are relative to the function directory
+    for key in ("detector_model_path", "detector_model_config_path"):
+        if config.get(key) and not os.path.isabs(config[key]):
+            config[key] = os.path.join(function_dir, config[key])
+
+    s3_client = boto3.client('s3')
+    ddb_table = boto3.resource('dynamodb').Table(config["ddb_table"])
+
+    detector = detectors.make_detector(config, boto3.client('rekognition'))
+    watch_list = watchlist.WatchList.from_config(config)
+
+    #A loaded OpenCV network must not be run by several threads at once
+    concurrency = args.concurrency if config.get("detector_backend", "rekognition") == "rekognition" else 1
+
+    start_t = time.time()
+    counts = {'enriched': 0, 'skipped': 0, 'failed': 0}
+
+    def collect(window):
+        for frame_id, future in window:
+            try:
+                if future.result() is None:
+                    counts['skipped'] += 1
+                    continue
+            except Exception as e:
+                #Left pending, so that the next run retries it
+                print("Failed to enrich frame {}. Error: {}".format(frame_id, e))
+                counts['failed'] += 1
+                continue
+
+            counts['enriched'] += 1
+            if counts['enriched'] % report_interval_frames == 0:
+                print("Enriched {} frames so far.".format(counts['enriched']))
+
+    def limit_reached(in_flight=0):
+        return args.max_frames and sum(counts.values()) + in_flight >= args.max_frames
+
+    #Frames are submitted in bounded windows as the GSI is paged through, so memory does not grow with the backlog
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for year_month in pending_year_months(args.months, config):
+            print("Enriching frames pending in {}.".format(year_month))
+
+            window = []
+            for frame_id in query_pending_frame_ids(ddb_table, args.gsi_name, year_month):
+                if limit_reached(len(window)):
+                    break
+
+                window.append((frame_id, executor.submit(enrich_frame, frame_id, detector, watch_list, config, s3_client)))
+                if len(window) >= concurrency * window_frames_per_thread:
+                    collect(window)
+                    window = []
+
+            collect(window)
+
+            if limit_reached():
+                break
+
+    print("Enriched {} frames in {:.1f} secs. {} no longer pending, {} failed.".format(
+        counts['enriched'], time.time() - start_t, counts['skipped'], counts['failed']))
+
+if __name__ == '__main__':
+    main()
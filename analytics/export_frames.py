@@ -0,0 +1,294 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytz
+
+import common
+
+#Export parameters
+default_out_dir = "exports/frames"
+default_since_days = 30 #first run only: how far back to export
+default_settle_secs = 300 #frames processed more recently may not be written to DynamoDB yet
+default_row_group_rows = 50000
+default_max_buffered_rows = 200000 #bounds memory, across all partitions
+default_max_open_files = 64
+default_enriched_gsi_name = "enriched_year_month-enriched_timestamp-index"
+checkpoint_file_name = "_checkpoint.json"
+
+#One row per label instance. Labels without instances (e.g. scene-level labels) have one row with null instance columns.
+schema = pa.schema([
+    ("frame_id", pa.string()),
+    ("camera_id", pa.string()),
+    ("processed_ts", pa.timestamp("ms", tz="UTC")),
+    ("capture_ts", pa.timestamp("ms", tz="UTC")),
+    ("label", pa.string()),
+    ("label_confidence", pa.float32()),
+    ("parents", pa.list_(pa.string())),
+    ("on_watch_list", pa.bool_()),
+    ("instance_index", pa.int16()),
+    ("instance_confidence", pa.float32()),
+    ("bbox_left", pa.float32()),
+    ("bbox_top", pa.float32()),
+    ("bbox_width", pa.float32()),
+    ("bbox_height", pa.float32()),
+    ("track_id", pa.string()),
+    ("s3_key", pa.string())
+])
+
+
+def to_float(d):
+    return None if d is None else float(d)
+
+
+def frame_rows(item):
+    '''Flattens the nested labels of a frame item into rows of plain Python values.'''
+    processed_ts = datetime.datetime.fromtimestamp(float(item['processed_timestamp']), pytz.utc)
+    capture_ts = datetime.datetime.fromtimestamp(float(item['approx_capture_timestamp']), pytz.utc)
+
+    common = {
+        'frame_id': item['frame_id'],
+        'camera_id': item.get('camera_id', 'default'),
+        'processed_ts': processed_ts,
+        'capture_ts': capture_ts,
+        's3_key': item.get('s3_key')
+    }
+
+    for label in item.get('rekog_labels', []):
+        label_row = dict(common)
+        label_row.update({
+            'label': label['Name'],
+            'label_confidence': to_float(label.get('Confidence')),
+            'parents': [parent['Name'] for parent in label.get('Parents', [])],
+            'on_watch_list': bool(label.get('OnWatchList', False))
+        })
+
+        instances = label.get('Instances') or []
+        if not instances:
+            label_row['track_id'] = label.get('TrackId')
+            yield label_row
+            continue
+
+        for instance_index, instance in enumerate(instances):
+            row = dict(label_row)
+            bounding_box = instance.get('BoundingBox', {})
+            row.update({
+                'instance_index': instance_index,
+                'instance_confidence': to_float(instance.get('Confidence')),
+                'bbox_left': to_float(bounding_box.get('Left')),
+                'bbox_top': to_float(bounding_box.get('Top')),
+                'bbox_width': to_float(bounding_box.get('Width')),
+                'bbox_height': to_float(bounding_box.get('Height')),
+                'track_id': instance.get('TrackId')
+            })
+            yield row
+
+
+def partition_of(row):
+    '''Hive-style partition directory of a row: UTC capture day, then camera.'''
+    return "day={}/camera={}".format(row['capture_ts'].strftime("%Y-%m-%d"), row['camera_id'])
+
+
+class PartitionedWriter(object):
+    '''Buffers rows per partition and writes them as Parquet row groups, with bounded memory and open files.
+
+    Each partition gets one part file per run. Files are written under a ".tmp" name and renamed when
+    closed, so readers never see incomplete files.
+    '''
+
+    def __init__(self, out_dir, run_tag, row_group_rows, max_buffered_rows, max_open_files):
+        self.out_dir = out_dir
+        self.run_tag = run_tag
+        self.row_group_rows = row_group_rows
+        self.max_buffered_rows = max_buffered_rows
+        self.max_open_files = max_open_files
+
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.writers = OrderedDict() #partition -> (writer, tmp path), least recently written first
+        self.file_seq = 0
+        self.rows_written = 0
+        self.files_written = 0
+
+    def add(self, row):
+        partition = partition_of(row)
+        buff = self.buffers.setdefault(partition, [])
+        buff.append(row)
+        self.buffered_rows += 1
+
+        if len(buff) >= self.row_group_rows:
+            self.flush(partition)
+        elif self.buffered_rows >= self.max_buffered_rows:
+            self.flush(max(self.buffers, key=lambda p: len(self.buffers[p])))
+
+    def flush(self, partition):
+        rows = self.buffers.pop(partition, None)
+        if not rows:
+            return
+        self.buffered_rows -= len(rows)
+
+        if partition in self.writers:
+            self.writers.move_to_end(partition)
+        else:
+            if len(self.writers) >= self.max_open_files:
+                self.close_file(next(iter(self.writers)))
+
+            part_dir = os.path.join(self.out_dir, partition)
+            if not os.path.exists(part_dir):
+                os.makedirs(part_dir)
+
+            tmp_path = os.path.join(part_dir, "part-{}-{:05d}.parquet.tmp".format(self.run_tag, self.file_seq))
+            self.file_seq += 1
+            self.writers[partition] = (pq.ParquetWriter(tmp_path, schema, compression="zstd"), tmp_path)
+
+        writer, tmp_path = self.writers[partition]
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        self.rows_written += len(rows)
+
+    def close_file(self, partition):
+        writer, tmp_path = self.writers.pop(partition)
+        writer.close()
+        os.rename(tmp_path, tmp_path[:-len(".tmp")])
+        self.files_written += 1
+
+    def close(self):
+        for partition in list(self.buffers):
+            self.flush(partition)
+        for partition in list(self.writers):
+            self.close_file(partition)
+
+
+def read_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def query_new_frames(ddb_table, gsi_name, year_month, start_ts, end_ts, hash_attr='processed_year_month', range_attr='processed_timestamp'):
+    '''Yields the frames of one month processed (or, with the enriched GSI's keys, enriched) in (start_ts, end_ts],
+    oldest first, one page at a time.'''
+    query_kwargs = {
+        'IndexName': gsi_name,
+        'KeyConditionExpression': Key(hash_attr).eq(year_month)
+            & Key(range_attr).gt(Decimal(repr(start_ts))),
+        'ScanIndexForward': True
+    }
+
+    while True:
+        ddb_resp = ddb_table.query(**query_kwargs)
+
+        for item in ddb_resp['Items']:
+            if float(item[range_attr]) > end_ts:
+                return
+            yield item
+
+        if 'LastEvaluatedKey' not in ddb_resp:
+            return
+        query_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Export new enriched frame metadata to Parquet files partitioned by day and camera.")
+    parser.add_argument("--table", default="EnrichedFrame",
+        help="DynamoDB frame table. Default is 'EnrichedFrame'.")
+    parser.add_argument("--gsi-name", default="processed_year_month-processed_timestamp-index",
+        help="name of the frame table GSI on processed_year_month and processed_timestamp.")
+    parser.add_argument("--enriched-gsi-name", default=default_enriched_gsi_name,
+        help="name of the frame table's sparse GSI on enriched_year_month and enriched_timestamp. Default is '{}'.".format(default_enriched_gsi_name))
+    parser.add_argument("--timezone", default="US/Eastern",
+        help="timezone of processed_year_month, i.e. Image Processor's 'timezone' parameter. Default is 'US/Eastern'.")
+    parser.add_argument("--out-dir", default=default_out_dir,
+        help="root directory of the partitioned dataset. Default is '{}'.".format(default_out_dir))
+    parser.add_argument("--since-days", type=float, default=default_since_days,
+        help="on the first run (no checkpoint), export frames processed in the last X days. Default is {}.".format(default_since_days))
+    parser.add_argument("--settle-secs", type=float, default=default_settle_secs,
+        help="leave out frames processed in the last X seconds, which may not be stored yet. Default is {}.".format(default_settle_secs))
+    parser.add_argument("--row-group-rows", type=int, default=default_row_group_rows,
+        help="rows per Parquet row group. Default is {}.".format(default_row_group_rows))
+    parser.add_argument("--max-buffered-rows", type=int, default=default_max_buffered_rows,
+        help="maximum rows held in memory across all partitions. Default is {}.".format(default_max_buffered_rows))
+
+    args = parser.parse_args()
+
+    tz = pytz.timezone(args.timezone)
+    ddb_table = boto3.resource('dynamodb').Table(args.table)
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    checkpoint_path = os.path.join(args.out_dir, checkpoint_file_name)
+    checkpoint = read_checkpoint(checkpoint_path)
+
+    end_ts = time.time() - args.settle_secs
+    start_ts = checkpoint['processed_timestamp'] if checkpoint else end_ts - args.since_days * 24 * 60 * 60
+
+    if end_ts <= start_ts:
+        print("Nothing to export yet.")
+        return
+
+    #A run exports (start_ts, end_ts], and names its files after start_ts. Files left by an interrupted
+    #run from the same checkpoint are removed, so that rerunning it never duplicates rows.
+    run_tag = "{:013d}".format(int(start_ts * 1000))
+    for stale_path in glob.glob(os.path.join(args.out_dir, "day=*", "camera=*", "part-{}-*".format(run_tag))):
+        os.remove(stale_path)
+
+    print("Exporting frames processed from {} to {}.".format(
+        datetime.datetime.fromtimestamp(start_ts, tz).strftime("%Y-%m-%d %H:%M:%S %Z"),
+        datetime.datetime.fromtimestamp(end_ts, tz).strftime("%Y-%m-%d %H:%M:%S %Z")))
+
+    start_t = time.time()
+    writer = PartitionedWriter(args.out_dir, run_tag, args.row_group_rows, args.max_buffered_rows, default_max_open_files)
+    frame_count = [0]
+
+    def export(item):
+        for row in frame_rows(item):
+            writer.add(row)
+
+        frame_count[0] += 1
+        if frame_count[0] % 10000 == 0:
+            print("Exported {} frames, {} rows so far.".format(frame_count[0], writer.rows_written + writer.buffered_rows))
+
+    for year_month in common.year_months(start_ts, end_ts, tz):
+        for item in query_new_frames(ddb_table, args.gsi_name, year_month, start_ts, end_ts):
+            #Frames stored without labels while shedding load, and labeled since, are exported as of their
+            #enrichment (below). Pending ones have no rows yet, and are exported once enriched.
+            if 'enriched_timestamp' not in item:
+                export(item)
+
+        #Frames enriched by analytics/enrich_pending_frames.py, whose processing time an earlier export may have passed
+        for item in query_new_frames(ddb_table, args.enriched_gsi_name, year_month, start_ts, end_ts,
+                'enriched_year_month', 'enriched_timestamp'):
+            export(item)
+
+    writer.close()
+
+    #Only once every file of the run is complete
+    common.write_json(checkpoint_path, {
+        'processed_timestamp': end_ts,
+        'frames_exported': frame_count[0],
+        'rows_exported': writer.rows_written,
+        'exported_at': time.time()
+    })
+
+    print("Exported {} frames as {} rows in {} files in {:.1f} secs.".format(
+        frame_count[0], writer.rows_written, writer.files_written, time.time() - start_t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import pytz
+
+import common
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "imageprocessor"))
+import watchlist
+
+#Re-evaluation parameters
+default_out_dir = "exports/watchlist"
+default_segments = 8
+checkpoint_interval_secs = 5
+report_interval_secs = 10
+checkpoint_file_name = "checkpoint.json"
+report_file_name = "report.json"
+
+#Only what the rules and the match records need. Frame images and other attributes are never read.
+projection = "frame_id, camera_id, processed_timestamp, approx_capture_timestamp, rekog_labels"
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def to_ddb_json(key):
+    '''Converts a LastEvaluatedKey to DynamoDB JSON, which round-trips exactly through the checkpoint file.'''
+    return None if key is None else dict((name, serializer.serialize(value)) for name, value in key.items())
+
+
+def from_ddb_json(key):
+    return None if key is None else dict((name, deserializer.deserialize(value)) for name, value in key.items())
+
+
+def new_stats():
+    return {
+        'frames_scanned': 0,
+        'frames_unlabeled': 0,
+        'frames_matched': 0,
+        'frames_newly_matched': 0,
+        'frames_no_longer_matched': 0,
+        'matches_by_label': {},
+        'matches_by_camera': {},
+        'matches_by_day': {}
+    }
+
+
+def merge_stats(into, stats):
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            for key, count in value.items():
+                into[name][key] = into[name].get(key, 0) + count
+        else:
+            into[name] += value
+
+
+def count(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def evaluate_frame(item, watch_list, tz, stats):
+    '''Applies the watch list to a stored frame. Returns its match record, or None if the result is a non-match both before and after.'''
+    labels = item.get('rekog_labels', [])
+    stats['frames_scanned'] += 1
+    if not labels:
+        #e.g. stored without labels while Image Processor was shedding load
+        stats['frames_unlabeled'] += 1
+        return None
+
+    matched = watch_list.matching_labels(labels)
+    was_matched = any(label.get('OnWatchList') for label in labels)
+    if not matched and not was_matched:
+        return None
+
+    processed_ts = float(item['processed_timestamp'])
+
+    if matched:
+        stats['frames_matched'] += 1
+        count(stats['matches_by_camera'], item.get('camera_id', 'default'))
+        count(stats['matches_by_day'], datetime.datetime.fromtimestamp(processed_ts, tz).strftime("%Y-%m-%d"))
+        for label in matched:
+            count(stats['matches_by_label'], label['Name'])
+        if not was_matched:
+            stats['frames_newly_matched'] += 1
+    else:
+        stats['frames_no_longer_matched'] += 1
+
+    return {
+        'frame_id': item['frame_id'],
+        'camera_id': item.get('camera_id', 'default'),
+        'processed_timestamp': processed_ts,
+        'approx_capture_timestamp': float(item['approx_capture_timestamp']),
+        'status': ('match' if was_matched else 'new_match') if matched else 'no_longer_match',
+        'labels': [{
+            'name': label['Name'],
+            'confidence': float(label['Confidence']),
+            #Alerts fire once per track, so distinct track ids count the alerts these frames would have raised
+            'track_ids': [instance['TrackId'] for instance in label.get('Instances', []) if 'TrackId' in instance] \
+                or ([label['TrackId']] if 'TrackId' in label else [])
+        } for label in matched]
+    }
+
+
+class Run(object):
+    '''Re-evaluation state shared by all units of work, and checkpointed together.
+
+    A unit is a scan segment or a GSI month. Each unit appends match records to its own file. The
+    checkpoint records, per unit, the key to resume from and the size of its file at that point, so
+    that a resumed run truncates records written after the last checkpoint and redoes those pages.
+    '''
+
+    def __init__(self, out_dir, checkpoint):
+        self.out_dir = out_dir
+        self.checkpoint = checkpoint
+        self.lock = threading.Lock()
+        self.last_checkpoint_t = 0
+        self.last_report_t = time.time()
+        self.start_t = time.time()
+        self.frames_this_run = 0
+
+    def unit(self, name):
+        return self.checkpoint['units'][name]
+
+    def matches_path(self, name):
+        return os.path.join(self.out_dir, "matches-{}.jsonl".format(name))
+
+    def page_done(self, name, last_key, matches_bytes, stats):
+        with self.lock:
+            unit = self.unit(name)
+            unit['last_key'] = to_ddb_json(last_key)
+            unit['done'] = last_key is None
+            unit['matches_bytes'] = matches_bytes
+            merge_stats(unit['stats'], stats)
+            self.frames_this_run += stats['frames_scanned']
+
+            now = time.time()
+            if unit['done'] or now - self.last_checkpoint_t >= checkpoint_interval_secs:
+                self.save()
+            if now - self.last_report_t >= report_interval_secs:
+                self.last_report_t = now
+                print("Re-evaluated {} frames ({:.0f} frames/sec), {} of {} units done.".format(
+                    self.frames_this_run, self.frames_this_run / max(now - self.start_t, 1e-6),
+                    sum(1 for unit in self.checkpoint['units'].values() if unit['done']), len(self.checkpoint['units'])))
+
+    def save(self):
+        self.last_checkpoint_t = time.time()
+        common.write_json(os.path.join(self.out_dir, checkpoint_file_name), self.checkpoint)
+
+
+def run_unit(run, name, table_name, read_kwargs, watch_list, tz):
+    '''Streams one unit's frames page by page, from its checkpointed key, appending match records to its file.'''
+    unit = run.unit(name)
+    if unit['done']:
+        return
+
+    #boto3 resources are not thread-safe, so every unit gets its own, from its own session
+    ddb_table = boto3.session.Session().resource('dynamodb').Table(table_name)
+
+    read_kwargs = dict(read_kwargs, ProjectionExpression=projection)
+    use_query = 'KeyConditionExpression' in read_kwargs
+    last_key = from_ddb_json(unit['last_key'])
+
+    with open(run.matches_path(name), 'ab+') as matches_file:
+        #Drop records written after the last checkpoint. Their pages are read again.
+        matches_file.truncate(unit['matches_bytes'])
+        matches_file.seek(unit['matches_bytes'])
+
+        while True:
+            if last_key:
+                read_kwargs['ExclusiveStartKey'] = last_key
+            ddb_resp = ddb_table.query(**read_kwargs) if use_query else ddb_table.scan(**read_kwargs)
+
+            stats = new_stats()
+            for item in ddb_resp['Items']:
+                record = evaluate_frame(item, watch_list, tz, stats)
+                if record:
+                    matches_file.write((json.dumps(record) + "\n").encode('utf-8'))
+            matches_file.flush()
+
+            last_key = ddb_resp.get('LastEvaluatedKey')
+            run.page_done(name, last_key, matches_file.tell(), stats)
+
+            if last_key is None:
+                return
+
+
+def parse_day(day, tz):
+    return tz.localize(datetime.datetime.strptime(day, "%Y-%m-%d"))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Re-evaluate Watch List rules over stored frame labels, without calling Amazon Rekognition.")
+    parser.add_argument("--params", default="config/imageprocessor-params.json",
+        help="Image Processor parameters file, for the Watch List rules, frame table, and timezone.")
+    parser.add_argument("--watch-list", default=None,
+        help="comma-separated labels to evaluate instead of the parameters file's label_watch_list.")
+    parser.add_argument("--min-conf", type=float, default=None,
+        help="minimum confidence to evaluate instead of the parameters file's label_watch_min_conf.")
+    parser.add_argument("--since", default=None,
+        help="first day (YYYY-MM-DD, in Image Processor's timezone) of frames to evaluate. Reads the frame table's GSI month by month instead of scanning it.")
+    parser.add_argument("--until", default=None,
+        help="last day (YYYY-MM-DD) of frames to evaluate, with --since. Default is today.")
+    parser.add_argument("--gsi-name", default="processed_year_month-processed_timestamp-index",
+        help="name of the frame table GSI on processed_year_month and processed_timestamp.")
+    parser.add_argument("--segments", type=int, default=default_segments,
+        help="parallel scan segments, or months read in parallel with --since. Default is {}.".format(default_segments))
+    parser.add_argument("--out-dir", default=default_out_dir,
+        help="directory of match records, report, and checkpoint. Default is '{}'.".format(default_out_dir))
+    parser.add_argument("--restart", action="store_true",
+        help="discard the checkpoint and previous results in the output directory, and start over.")
+    args = parser.parse_args()
+
+    with open(args.params, 'r') as params_file:
+        config = json.load(params_file)
+
+    watch_list = watchlist.WatchList(
+        args.watch_list.split(",") if args.watch_list is not None else config["label_watch_list"],
+        args.min_conf if args.min_conf is not None else config["label_watch_min_conf"])
+    tz = pytz.timezone(config["timezone"])
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    checkpoint_path = os.path.join(args.out_dir, checkpoint_file_name)
+    checkpoint = None
+    if os.path.exists(checkpoint_path) and not args.restart:
+        with open(checkpoint_path, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+    #Units of work: months of the GSI within a time range, or segments of a full table scan
+    if args.since:
+        start_ts = (parse_day(args.since, tz) - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+        if args.until:
+            end_ts = (parse_day(args.until, tz) + datetime.timedelta(days=1) - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+        elif checkpoint and checkpoint['scope'].get('since') == args.since and not checkpoint['scope'].get('until') \
+                and 'end_ts' in checkpoint['scope']:
+            #Without --until, the range ends when the run started. A resumed run reads the same range, whatever the time now.
+            end_ts = checkpoint['scope']['end_ts']
+        else:
+            end_ts = time.time()
+        scope = {'mode': 'gsi', 'since': args.since, 'until': args.until, 'end_ts': end_ts}
+
+        units = dict(("month-{}".format(year_month), {
+            'IndexName': args.gsi_name,
+            'KeyConditionExpression': Key('processed_year_month').eq(year_month)
+                & Key('processed_timestamp').between(Decimal(repr(start_ts)), Decimal(repr(end_ts)))
+        }) for year_month in common.year_months(start_ts, end_ts, tz))
+    else:
+        scope = {'mode': 'scan', 'segments': args.segments}
+
+        units = dict(("segment-{:03d}".format(segment), {
+            'Segment': segment,
+            'TotalSegments': args.segments
+        }) for segment in range(args.segments))
+
+    if checkpoint is not None:
+        if checkpoint['rules'] != watch_list.to_dict() or checkpoint['scope'] != scope:
+            raise Exception("'{}' holds a run with other rules or scope ({}, {}). Use another --out-dir, or --restart.".format(
+                args.out_dir, checkpoint['rules'], checkpoint['scope']))
+
+        print("Resuming from checkpoint, {} of {} units done.".format(
+            sum(1 for unit in checkpoint['units'].values() if unit['done']), len(checkpoint['units'])))
+
+    if checkpoint is None:
+        for name in os.listdir(args.out_dir):
+            if name.startswith("matches-") or name in (checkpoint_file_name, report_file_name):
+                os.remove(os.path.join(args.out_dir, name))
+
+        checkpoint = {
+            'rules': watch_list.to_dict(),
+            'scope': scope,
+            'units': dict((name, {'last_key': None, 'done': False, 'matches_bytes': 0, 'stats': new_stats()}) for name in units)
+        }
+
+    print("Re-evaluating Watch List {} with minimum confidence {} over {} units ({}).".format(
+        watch_list.labels, watch_list.min_conf, len(units), scope['mode']))
+
+    run = Run(args.out_dir, checkpoint)
+    run.save()
+
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        futures = [executor.submit(run_unit, run, name, config["ddb_table"], read_kwargs, watch_list, tz) \
+            for name, read_kwargs in sorted(units.items())]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            with run.lock:
+                run.save()
+
+    report = new_stats()
+    for unit in checkpoint['units'].values():
+        merge_stats(report, unit['stats'])
+    report.update({
+        'rules': checkpoint['rules'],
+        'scope': scope,
+        'match_files': sorted(os.path.basename(run.matches_path(name)) for name in units),
+        'completed_at': datetime.datetime.now(tz).isoformat()
+    })
+    common.write_json(os.path.join(args.out_dir, report_file_name), report)
+
+    print("Done in {:.1f} secs. {} frames scanned, {} unlabeled. {} would alert ({} not alerted at the time), {} alerted but no longer would.".format(
+        time.time() - run.start_t, report['frames_scanned'], report['frames_unlabeled'], report['frames_matched'],
+        report['frames_newly_matched'], report['frames_no_longer_matched']))
+    print("Matches by label: {}".format(json.dumps(report['matches_by_label'], sort_keys=True)))
+    print("Report written to '{}'.".format(os.path.join(args.out_dir, report_file_name)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+# Compares Image Processor detector backends on the same frames:
+#
+#   rekognition : Amazon Rekognition DetectLabels, one remote call per frame.
+#   opencv      : the local CPU model run by the OpenCV DNN module.
+#   cascade     : the local model on every frame, Rekognition only on frames with a label of interest.
+#
+# For each backend, reports setup time (e.g. loading the model), per-frame latency, and sequential
+# throughput. For cascade, also reports the share of frames forwarded to Rekognition.
+# Backend settings are read from Image Processor's parameters file. Backends that cannot run here
+# (no AWS credentials, no OpenCV, no model file) are skipped.
+#
+# usage: python bench_detectors.py [--images DIR] [--frames N] [--backends rekognition,opencv,cascade]
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "imageprocessor"))
+import detectors
+
+default_params_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config", "imageprocessor-params.json")
+
+
+def load_frames(images_dir, frame_count):
+    '''Returns JPEG frames from a directory, or synthetic 1280x720 frames if no directory is given.'''
+    if images_dir:
+        paths = sorted(glob.glob(os.path.join(images_dir, "*.jpg")) + glob.glob(os.path.join(images_dir, "*.jpeg")))
+        if not paths:
+            raise IOError("No JPEG images in '{}'".format(images_dir))
+        frames = []
+        for path in paths[:frame_count]:
+            with open(path, "rb") as img_file:
+                frames.append(img_file.read())
+        return frames
+
+    import cv2
+    import numpy as np
+    frames = []
+    for i in range(frame_count):
+        img = np.full((720, 1280, 3), 40 + (i * 7) % 160, dtype=np.uint8)
+        cv2.rectangle(img, (100 + i % 400, 200), (400 + i % 400, 650), (200, 120, 60), -1)
+        frames.append(cv2.imencode(".jpg", img)[1].tobytes())
+    return frames
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run(backend, config, frames):
+    backend_config = dict(config, detector_backend=backend)
+
+    rekog_client = None
+    if backend in ("rekognition", "cascade"):
+        import boto3
+        rekog_client = boto3.client("rekognition")
+
+    start_t = time.time()
+    detector = detectors.make_detector(backend_config, rekog_client)
+    setup_secs = time.time() - start_t
+
+    #Count frames the cascade forwards to Rekognition
+    forwarded = [0]
+    if backend == "cascade":
+        remote_detect = detector.remote_detector.detect
+        def counting_detect(img_bytes):
+            forwarded[0] += 1
+            return remote_detect(img_bytes)
+        detector.remote_detector.detect = counting_detect
+
+    #One warm-up frame, e.g. for lazy allocations and connection setup
+    detector.detect(frames[0])
+    forwarded[0] = 0
+
+    latencies = []
+    start_t = time.time()
+    for img_bytes in frames:
+        frame_t = time.time()
+        detector.detect(img_bytes)
+        latencies.append(time.time() - frame_t)
+    elapsed = time.time() - start_t
+
+    print("{:12} | setup {:7.1f} ms | latency p50 {:7.1f} p95 {:7.1f} p99 {:7.1f} ms | {:6.1f} frames/s{}".format(
+        backend, setup_secs * 1000,
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000,
+        len(frames) / elapsed,
+        " | {:.0%} forwarded to Rekognition".format(forwarded[0] / float(len(frames))) if backend == "cascade" else ""))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compare Image Processor detector backends.")
+    parser.add_argument("--images", default="",
+        help="directory of JPEG frames. Default is synthetic 1280x720 frames.")
+    parser.add_argument("--frames", type=int, default=50,
+        help="number of frames per backend. Default is 50.")
+    parser.add_argument("--backends", default="rekognition,opencv,cascade",
+        help="comma-separated backends to run. Default is all.")
+    parser.add_argument("--params", default=default_params_path,
+        help="Image Processor parameters file with the detector settings.")
+    args = parser.parse_args()
+
+    with open(args.params, "r") as params_file:
+        config = json.load(params_file)
+
+    #Model paths in the parameters file are relative to the function directory
+    function_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "imageprocessor")
+    for key in ("detector_model_path", "detector_model_config_path"):
+        if config.get(key) and not os.path.isabs(config[key]):
+            config[key] = os.path.join(function_dir, config[key])
+
+    frames = load_frames(args.images, args.frames)
+    print("{} frames, {:.0f} KB on average".format(len(frames), sum(len(frame) for frame in frames) / 1024.0 / len(frames)))
+
+    for backend in args.backends.split(","):
+        try:
+            run(backend, config, frames)
+        except Exception as e:
+            print("{:12} | skipped: {}".format(backend, e))
+
+
+if __name__ == '__main__':
+    main()
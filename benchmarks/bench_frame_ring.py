@@ -0,0 +1,195 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+# Compares two ways of handing raw frames from the capture loop to worker processes:
+#
+#   pickle : pool.apply_async(worker, (frame, ...)) -- the frame is pickled and piped to a worker.
+#   ring   : the frame is written once into a shared memory FrameRing slot; only the slot index is sent.
+#
+# Workers JPEG-encode every frame with cv2.imencode, as the capture clients' encoder processes do.
+# For each capture rate, reports how long the capture loop spends handing frames off, how late
+# capture ticks run as a result, end-to-end latency (capture to encoded JPEG), and the frame copies:
+#
+#   MB/s to workers : bytes that crossed the process boundary per second. Measured: the size of the
+#                     pickled task in pickle mode, the bytes written into slots in ring mode.
+#   copy ms/frame   : measured time of one frame's copies. Ring mode times every slot write in the
+#                     capture loop. Pickle mode times pickling and unpickling the task in the main
+#                     process, since apply_async() pickles on the pool's task thread (pipe I/O is left out).
+#
+# Note that in pickle mode the handoff cost shows up as late capture ticks (GIL contention) and
+# end-to-end latency rather than handoff time.
+#
+# usage: python bench_frame_ring.py [duration-secs] [width] [height]
+
+import os
+import pickle
+import sys
+import time
+from multiprocessing import Pool
+from multiprocessing.reduction import ForkingPickler
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+import frame_ring
+
+worker_count = 3
+ring_slots = 6
+fps_rates = (30, 60)
+
+ring = None
+
+
+def init_ring_worker(ring_args):
+    global ring
+    ring = frame_ring.FrameRing.attach(*ring_args)
+
+
+def warm_up(_):
+    return None
+
+
+def encode(buff, frame_shape):
+    '''Encodes a raw BGR frame to JPEG, as the capture clients' encoder processes do.'''
+    retval, jpeg = cv2.imencode(".jpg", np.frombuffer(buff, dtype=np.uint8).reshape(frame_shape))
+    return len(jpeg)
+
+
+def consume_pickled(frame, frame_shape, capture_ts):
+    encode(frame, frame_shape)
+    return time.time() - capture_ts
+
+
+def consume_slot(slot, frame_shape, capture_ts):
+    try:
+        encode(ring.buffer(slot), frame_shape)
+    finally:
+        ring.release(slot)
+    return time.time() - capture_ts
+
+
+def make_frame(frame_shape):
+    '''A synthetic frame with gradients and some noise, which encodes like camera footage rather than random bytes.'''
+    height, width = frame_shape[:2]
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.stack([(x * 255 // max(width - 1, 1)), (y * 255 // max(height - 1, 1)), ((x + y) % 256)], axis=2).astype(np.uint8)
+    img = cv2.add(img, np.random.randint(0, 16, img.shape, dtype=np.uint8))
+    return bytearray(img.tobytes())
+
+
+def measure_pickle_copy(frame, frame_shape, repeats=10):
+    '''Returns (bytes, median secs) of pickling and unpickling one pickle-mode task, as the pool does.'''
+    copy_secs = []
+    for _ in range(repeats):
+        start_t = time.time()
+        payload = ForkingPickler.dumps((frame, frame_shape, time.time()))
+        pickle.loads(payload)
+        copy_secs.append(time.time() - start_t)
+    return len(payload), percentile(copy_secs, 50)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run(mode, fps, duration, frame_shape):
+    frame = make_frame(frame_shape)
+    frame_size = len(frame)
+
+    capture_ring = None
+    if mode == "ring":
+        capture_ring = frame_ring.FrameRing.create(ring_slots, frame_size)
+        pool = Pool(processes=worker_count, initializer=init_ring_worker, initargs=(capture_ring.attach_args(),))
+    else:
+        pool = Pool(processes=worker_count)
+
+    #Warm up worker processes, and fault in shared memory pages
+    pool.map(warm_up, range(worker_count))
+    if capture_ring:
+        for slot in range(ring_slots):
+            capture_ring.write(slot, frame)
+
+    handoff_secs = []
+    copy_secs = []
+    lateness_secs = []
+    results = []
+    dropped = 0
+
+    interval = 1.0 / fps
+    start_t = time.time()
+    tick = 0
+    while True:
+        scheduled_t = start_t + tick * interval
+        if scheduled_t - start_t >= duration:
+            break
+
+        delay = scheduled_t - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        lateness_secs.append(max(0.0, time.time() - scheduled_t))
+
+        #"Capture" a new frame
+        frame[tick % frame_size] = tick % 256
+        capture_ts = time.time()
+
+        if mode == "ring":
+            slot = capture_ring.acquire()
+            if slot is None:
+                dropped += 1
+            else:
+                copy_t = time.time()
+                capture_ring.write(slot, frame)
+                copy_secs.append(time.time() - copy_t)
+                results.append(pool.apply_async(consume_slot, (slot, frame_shape, capture_ts)))
+        else:
+            results.append(pool.apply_async(consume_pickled, (frame, frame_shape, capture_ts)))
+
+        handoff_secs.append(time.time() - capture_ts)
+        tick += 1
+
+    latencies = [result.get() for result in results]
+    elapsed = time.time() - start_t
+
+    pool.close()
+    pool.join()
+    if capture_ring:
+        capture_ring.close()
+
+    if mode == "ring":
+        bytes_per_frame, copy_secs_per_frame = frame_size, percentile(copy_secs, 50)
+    else:
+        bytes_per_frame, copy_secs_per_frame = measure_pickle_copy(frame, frame_shape)
+    transfer_mb = len(results) * bytes_per_frame / elapsed / (1024 * 1024)
+
+    print("{:6} {:3d} fps | sent {:5d} dropped {:4d} | handoff p50 {:6.2f} p99 {:6.2f} max {:6.2f} ms | "
+        "tick late p99 {:6.2f} max {:6.2f} ms | e2e p50 {:7.2f} p99 {:7.2f} ms | {:6.0f} MB/s to workers | copy {:5.2f} ms/frame".format(
+        mode, fps, len(results), dropped,
+        percentile(handoff_secs, 50) * 1000, percentile(handoff_secs, 99) * 1000, max(handoff_secs) * 1000,
+        percentile(lateness_secs, 99) * 1000, max(lateness_secs) * 1000,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        transfer_mb, copy_secs_per_frame * 1000))
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 1920
+    height = int(sys.argv[3]) if len(sys.argv) > 3 else 1080
+
+    frame_shape = (height, width, 3) #BGR, 8 bits per channel, as returned by cv2.VideoCapture.read()
+
+    print("{}x{} frames ({:.1f} MB), {} workers, {} secs per run".format(
+        width, height, width * height * 3 / (1024.0 * 1024.0), worker_count, duration))
+
+    for fps in fps_rates:
+        for mode in ("pickle", "ring"):
+            run(mode, fps, duration, frame_shape)
+
+
+if __name__ == '__main__':
+    main()
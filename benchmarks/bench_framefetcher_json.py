@@ -0,0 +1,123 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+# Compares Frame Fetcher response serialization of a page of enriched frames:
+#
+#   encoder : json.dumps(items, cls=DecimalEncoder), the original Frame Fetcher serialization.
+#   fast    : serializer.to_json(), a compact dump (orjson if installed) that only calls back into Python for Decimals.
+#
+# Items are built the way Image Processor stores them: every confidence and bounding box value
+# is a Decimal made from a float, as read back from DynamoDB by boto3.
+#
+# usage: python bench_framefetcher_json.py [frames-per-page] [iterations]
+
+import decimal
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "framefetcher"))
+import serializer
+
+label_names = ["Person", "Human", "Car", "Automobile", "Vehicle", "Transportation", "Dog", "Pet", "Animal",
+    "Mammal", "Canine", "Furniture", "Chair", "Indoors", "Room", "Plant", "Potted Plant", "Bag", "Toy", "Road"]
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, o): # pylint: disable=E0202
+        if isinstance(o, decimal.Decimal):
+            if o % 1 > 0:
+                return float(o)
+            else:
+                return int(o)
+        return super(DecimalEncoder, self).default(o)
+
+
+def make_frame(rnd, ts):
+    labels = []
+    for name in rnd.sample(label_names, 12):
+        instances = []
+        if name in ("Person", "Car", "Dog", "Chair"):
+            for _ in range(rnd.randint(1, 5)):
+                instances.append({
+                    'BoundingBox': {
+                        'Width': Decimal(rnd.random()),
+                        'Height': Decimal(rnd.random()),
+                        'Left': Decimal(rnd.random()),
+                        'Top': Decimal(rnd.random())
+                    },
+                    'Confidence': Decimal(rnd.uniform(50, 100)),
+                    'TrackId': 'default:{}'.format(rnd.randint(1, 10000))
+                })
+        labels.append({
+            'Name': name,
+            'Confidence': Decimal(rnd.uniform(50, 100)),
+            'Instances': instances,
+            'Parents': [{'Name': rnd.choice(label_names)}],
+            'OnWatchList': False
+        })
+
+    frame_id = str(uuid.UUID(int=rnd.getrandbits(128)))
+    return {
+        'frame_id': frame_id,
+        'processed_timestamp': Decimal(ts),
+        'approx_capture_timestamp': Decimal(ts - 0.5),
+        'rekog_labels': labels,
+        'rekog_orientation_correction': 'ROTATE_0',
+        'processed_year_month': '201706',
+        's3_bucket': 'frame-bucket',
+        's3_key': 'frames/2017/06/01/13/{}.jpg'.format(frame_id),
+        's3_thumbnail_key': 'thumbnails/2017/06/01/13/{}.jpg'.format(frame_id),
+        'camera_id': 'default',
+        's3_presigned_url': 'https://frame-bucket.s3.amazonaws.com/thumbnails/2017/06/01/13/{}.jpg?X-Amz-Signature={}'.format(
+            frame_id, '0' * 64)
+    }
+
+
+def timeit(fn, iterations):
+    best = float('inf')
+    for _ in range(iterations):
+        start_t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start_t)
+    return best
+
+
+def main():
+    frame_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    rnd = random.Random(42)
+    items = [make_frame(rnd, 1496322000.0 + i) for i in range(frame_count)]
+
+    encoder_json = json.dumps(items, cls=DecimalEncoder)
+    fast_json = serializer.to_json(items)
+    if json.loads(fast_json) != json.loads(encoder_json):
+        raise Exception("serializer.to_json() output differs from DecimalEncoder output")
+
+    encoder_secs = timeit(lambda: json.dumps(items, cls=DecimalEncoder), iterations)
+    fast_secs = timeit(lambda: serializer.to_json(items), iterations)
+
+    print("{} frames per page, best of {} runs".format(frame_count, iterations))
+    print("encoder        : {:7.2f} ms, {:8d} bytes".format(encoder_secs * 1000, len(encoder_json)))
+
+    if serializer.orjson is not None:
+        print("fast (orjson)  : {:7.2f} ms, {:8d} bytes ({:.1f}x faster)".format(
+            fast_secs * 1000, len(fast_json), encoder_secs / fast_secs))
+
+        #Same, as deployed without orjson
+        orjson, serializer.orjson = serializer.orjson, None
+        fast_secs = timeit(lambda: serializer.to_json(items), iterations)
+        serializer.orjson = orjson
+
+    print("fast (json)    : {:7.2f} ms, {:8d} bytes ({:.1f}x faster)".format(
+        fast_secs * 1000, len(fast_json), encoder_secs / fast_secs))
+
+if __name__ == '__main__':
+    main()
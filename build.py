@@ -14,6 +14,10 @@ import json
 from subprocess import call
 import http.server
 import socketserver
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytz
 
 def write_dir_to_zip(src, zf):
     '''Write a directory tree to an open ZipFile object.'''
@@ -46,6 +50,185 @@ def check_bucket_exists(bucketname):
             exists = False
     return exists
 
+class PurgeProgress(object):
+    '''Thread-safe counters of a purge, printed at most once every few seconds.'''
+
+    def __init__(self, name, report_interval_secs=5):
+        self.name = name
+        self.report_interval_secs = report_interval_secs
+        self.lock = threading.Lock()
+        self.scanned = 0
+        self.deleted = 0
+        self.failed = 0
+        self.start_t = time.time()
+        self.last_report_t = self.start_t
+
+    def add(self, scanned=0, deleted=0, failed=0):
+        with self.lock:
+            self.scanned += scanned
+            self.deleted += deleted
+            self.failed += failed
+
+            now = time.time()
+            if now - self.last_report_t >= self.report_interval_secs:
+                self.last_report_t = now
+                self._print()
+
+    def report(self):
+        with self.lock:
+            self._print()
+
+    def _print(self):
+        elapsed = max(time.time() - self.start_t, 1e-6)
+        print("%s: scanned %d, deleted %d, failed %d (%.1f deletes/sec, %d secs elapsed)" \
+            % (self.name, self.scanned, self.deleted, self.failed, self.deleted / elapsed, int(elapsed)))
+
+def batch_delete_ddb_keys(dynamodb, table_name, keys):
+    '''Deletes items in batches of 25, retrying unprocessed items with exponential backoff.'''
+    for i in range(0, len(keys), 25): #BatchWriteItem maximum
+        request = {table_name: [{"DeleteRequest": {"Key": key}} for key in keys[i:i + 25]]}
+        backoff_secs = 0.05
+        while request:
+            response = dynamodb.batch_write_item(RequestItems=request)
+            request = response.get("UnprocessedItems")
+            if request:
+                time.sleep(backoff_secs)
+                backoff_secs = min(backoff_secs * 2, 5)
+
+def purge_ddb_segment(dynamodb, table_name, key_attrs, segment, total_segments, cutoff_ts, progress):
+    '''Scans one segment of a table for keys (of items processed before cutoff_ts, if set) and deletes them page by page.'''
+
+    scan_kwargs = {
+        "TableName": table_name,
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "ProjectionExpression": ", ".join("#k%d" % i for i in range(len(key_attrs))),
+        "ExpressionAttributeNames": dict(("#k%d" % i, attr) for i, attr in enumerate(key_attrs))
+    }
+
+    if cutoff_ts is not None:
+        scan_kwargs["FilterExpression"] = "#ts < :cutoff"
+        scan_kwargs["ExpressionAttributeNames"]["#ts"] = "processed_timestamp"
+        scan_kwargs["ExpressionAttributeValues"] = {":cutoff": {"N": str(cutoff_ts)}}
+
+    while True:
+        response = dynamodb.scan(**scan_kwargs)
+
+        batch_delete_ddb_keys(dynamodb, table_name, response["Items"])
+        progress.add(scanned=response["ScannedCount"], deleted=len(response["Items"]))
+
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def purge_ddb_table(table_name, key_attrs, total_segments, cutoff_ts=None):
+    '''Deletes all items of a table (or only those processed before cutoff_ts) using parallel segmented scans.'''
+    progress = PurgeProgress("DynamoDB table '%s'" % table_name)
+
+    #Clients are thread-safe, but creating them from the default session is not. So all threads share one.
+    dynamodb = boto3.client("dynamodb")
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [executor.submit(purge_ddb_segment, dynamodb, table_name, key_attrs, segment, total_segments, cutoff_ts, progress) \
+            for segment in range(total_segments)]
+        for future in futures:
+            future.result()
+
+    progress.report()
+
+def list_s3_subprefixes(s3_client, bucket_name, prefix):
+    '''Lists the "directories" directly under an S3 prefix.'''
+    subprefixes = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/"):
+        subprefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+
+    return subprefixes
+
+def expired_hour_prefixes(s3_client, bucket_name, root, cutoff_ts, tz):
+    '''Returns root/YYYY/MM/DD/HH prefixes of all hours that ended before cutoff_ts.
+
+    Hours are in the Image Processor timezone, as in its S3 keys. Prefixes have no trailing
+    slash, so they match both hourly frame "directories" and hourly Frame Compactor archives.
+    '''
+    hour_prefixes = []
+
+    for year_prefix in list_s3_subprefixes(s3_client, bucket_name, root):
+        for mon_prefix in list_s3_subprefixes(s3_client, bucket_name, year_prefix):
+            for day_prefix in list_s3_subprefixes(s3_client, bucket_name, mon_prefix):
+                try:
+                    year, mon, day = [int(part) for part in day_prefix[len(root):].strip("/").split("/")]
+                except ValueError:
+                    continue #Not a YYYY/MM/DD prefix
+
+                for hour in range(24):
+                    hour_start = tz.localize(datetime.datetime(year, mon, day, hour))
+                    hour_end_ts = (hour_start + datetime.timedelta(hours=1)).timestamp()
+                    if hour_end_ts <= cutoff_ts:
+                        hour_prefixes.append("%s%02d" % (day_prefix, hour))
+
+    return hour_prefixes
+
+def delete_s3_keys(s3_client, bucket_name, keys, max_attempts=5):
+    '''Deletes up to 1000 keys with one delete_objects call, retrying keys that fail with exponential backoff.
+
+    Returns the keys that still could not be deleted.
+    '''
+    backoff_secs = 0.05
+    for attempt in range(max_attempts):
+        response = s3_client.delete_objects(Bucket=bucket_name, Delete={"Objects": keys, "Quiet": True})
+
+        #In quiet mode, only failed keys are listed
+        errors = response.get("Errors", [])
+        if not errors:
+            return []
+
+        keys = [{"Key": error["Key"]} for error in errors]
+        if attempt < max_attempts - 1:
+            time.sleep(backoff_secs)
+            backoff_secs = min(backoff_secs * 2, 5)
+
+    for error in errors[:10]:
+        print("Could not delete s3://%s/%s: %s %s" % (bucket_name, error["Key"], error.get("Code"), error.get("Message")))
+
+    return keys
+
+def purge_s3_prefix(s3_client, bucket_name, prefix, progress):
+    '''Deletes all objects under a prefix, 1000 keys per delete_objects call.'''
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={"PageSize": 1000}):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        failed_keys = delete_s3_keys(s3_client, bucket_name, keys) if keys else []
+        progress.add(scanned=len(keys), deleted=len(keys) - len(failed_keys), failed=len(failed_keys))
+
+def purge_s3_hours(bucket_name, roots, cutoff_ts, tz, concurrency):
+    '''Deletes all objects stored under the given roots for hours that ended before cutoff_ts, hour prefixes in parallel.'''
+    s3_client = boto3.client("s3")
+    progress = PurgeProgress("S3 bucket '%s'" % bucket_name)
+
+    hour_prefixes = []
+    for root in roots:
+        hour_prefixes.extend(expired_hour_prefixes(s3_client, bucket_name, root, cutoff_ts, tz))
+
+    print("Purging %d hour prefixes in '%s' S3 bucket." % (len(hour_prefixes), bucket_name))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        #One client for all threads: clients are thread-safe, but creating them from the default session is not
+        futures = [executor.submit(purge_s3_prefix, s3_client, bucket_name, prefix, progress) for prefix in hour_prefixes]
+        for future in futures:
+            future.result()
+
+    progress.report()
+
+def frame_tables(img_processor_params_dict):
+    '''(table name, key attributes) of the DynamoDB tables holding per-frame data.'''
+    return [
+        (img_processor_params_dict["ddb_table"], ["frame_id"]),
+        (img_processor_params_dict["ddb_label_index_table"], ["label_bucket", "conf_frame"])
+    ]
+
 @task()
 def clean():
     '''Clean build directory.'''
@@ -65,7 +248,7 @@ def packagelambda(* functions):
     os.chdir("build")
 
     if(len(functions) == 0):
-        functions = ("framefetcher", "imageprocessor")
+        functions = ("framefetcher", "imageprocessor", "framecompactor")
 
     for function in functions:
         print('Packaging "%s" lambda function in directory' % function)
@@ -87,7 +270,7 @@ def updatelambda(*functions):
     lambda_client = boto3.client('lambda')
 
     if(len(functions) == 0):
-        functions = ("framefetcher", "imageprocessor")
+        functions = ("framefetcher", "imageprocessor", "framecompactor")
 
     for function in functions:
         with open('build/%s.zip' % (function), 'rb') as zipf:
@@ -104,7 +287,7 @@ def deploylambda(* functions, **kwargs):
     cfn_params_path = kwargs.get("cfn_params_path", "config/cfn-params.json")
 
     if(len(functions) == 0):
-        functions = ("framefetcher", "imageprocessor")
+        functions = ("framefetcher", "imageprocessor", "framecompactor")
 
     region_name = boto3.session.Session().region_name
     s3_keys = {}
@@ -113,6 +296,7 @@ def deploylambda(* functions, **kwargs):
     src_s3_bucket_name = cfn_params_dict["SourceS3BucketParameter"]
     s3_keys["framefetcher"] = cfn_params_dict["FrameFetcherSourceS3KeyParameter"]
     s3_keys["imageprocessor"] = cfn_params_dict["ImageProcessorSourceS3KeyParameter"]
+    s3_keys["framecompactor"] = cfn_params_dict["FrameCompactorSourceS3KeyParameter"]
 
     s3_client = boto3.client("s3")
     
@@ -377,39 +561,66 @@ def webuiserver(webdir="web-ui/",port=8080):
     return
 
 @task()
-def videocaptureip(videouri, capturerate="30", clientdir="client"):
-    '''Run the IP camera video capture client using parameters video URI and frame capture rate.'''
+def videocaptureip(videouri, capturerate="30", clientdir="client", cameraid="ipcam"):
+    '''Run the IP camera video capture client using parameters video URI, frame capture rate, and camera id.'''
     os.chdir(clientdir)
     
-    call(["python", "video_cap_ipcam.py", videouri, capturerate])
+    call(["python", "video_cap_ipcam.py", videouri, capturerate, cameraid])
 
     os.chdir("..")
 
     return
 
 @task()
-def videocapture(capturerate="30",clientdir="client"):
+def videocapture(capturerate="30",clientdir="client",cameraid="default"):
     '''Run the video capture client with built-in camera. Default capture rate is 1 every 30 frames.'''
     os.chdir(clientdir)
     
-    call(["python", "video_cap.py", capturerate])
+    call(["python", "video_cap.py", capturerate, cameraid])
+
+    os.chdir("..")
+
+    return
+
+@task()
+def videoreplay(*videofiles, **kwargs):
+    '''Replay recorded video files into the frame stream at real time, a multiple of real time (speed=X), or as fast as possible (speed=0).'''
+    clientdir = kwargs.get("clientdir", "client")
+
+    args = [os.path.abspath(videofile) for videofile in videofiles]
+    args += ["--speed", str(kwargs.get("speed", "1"))]
+    args += ["--capture-rate", str(kwargs.get("capturerate", "30"))]
+    args += ["--workers", str(kwargs.get("workers", "4"))]
+
+    if kwargs.get("cameraid"):
+        args += ["--camera-id", kwargs["cameraid"]]
+
+    if kwargs.get("endpointurl"):
+        args += ["--endpoint-url", kwargs["endpointurl"]]
+
+    os.chdir(clientdir)
+
+    call(["python", "video_replay.py"] + args)
 
     os.chdir("..")
 
     return
 
 @task()
-def deletedata(global_params_path="config/global-params.json", cfn_params_path="config/cfn-params.json", image_processor_params_path="config/imageprocessor-params.json"):
+def deletedata(global_params_path="config/global-params.json", cfn_params_path="config/cfn-params.json", image_processor_params_path="config/imageprocessor-params.json", segments="8"):
     '''DELETE ALL collected frames and metadata in Amazon S3 and Amazon DynamoDB. Use with caution!'''
     
     cfn_params_dict = read_json(cfn_params_path)
     img_processor_params_dict = read_json(image_processor_params_path)
 
     frame_s3_bucket_name = cfn_params_dict["FrameS3BucketNameParameter"]
-    frame_ddb_table_name = img_processor_params_dict["ddb_table"]
+    ddb_tables = frame_tables(img_processor_params_dict) + [
+        (img_processor_params_dict["ddb_rollup_table"], ["rollup_key", "bucket_ts"]),
+        (img_processor_params_dict["ddb_track_state_table"], ["camera_id"])
+    ]
 
-    proceed = input("This command will DELETE ALL DATA in S3 bucket '%s' and DynamoDB table '%s'.\nDo you wish to continue? [Y/N] " \
-        % (frame_s3_bucket_name, frame_ddb_table_name))
+    proceed = input("This command will DELETE ALL DATA in S3 bucket '%s' and DynamoDB tables %s.\nDo you wish to continue? [Y/N] " \
+        % (frame_s3_bucket_name, ", ".join("'%s'" % table_name for table_name, key_attrs in ddb_tables)))
 
     if(proceed.lower() != 'y'):
         print("Aborting deletion.")
@@ -421,46 +632,105 @@ def deletedata(global_params_path="config/global-params.json", cfn_params_path="
     s3 = boto3.resource('s3')
     s3.Bucket(frame_s3_bucket_name).objects.delete()
 
-    print("Attempting to DELETE ALL ITEMS in '%s' DynamoDB table." % frame_ddb_table_name)
-    dynamodb = boto3.client('dynamodb')
-    ddb_table = boto3.resource('dynamodb').Table(frame_ddb_table_name)
-
-    last_eval_key = None
-    keep_scanning = True
-    batch_count = 0
-    while keep_scanning:
-        batch_count += 1
-
-        if(keep_scanning and last_eval_key):
-            response = dynamodb.scan(
-                TableName=frame_ddb_table_name,
-                Select='SPECIFIC_ATTRIBUTES',
-                AttributesToGet=[
-                    'frame_id',
-                ],
-                ExclusiveStartKey=last_eval_key
-            )
-        else:
-            response = dynamodb.scan(
-                TableName=frame_ddb_table_name,
-                Select='SPECIFIC_ATTRIBUTES',
-                AttributesToGet=[
-                    'frame_id',
-                ]
-            )
+    for table_name, key_attrs in ddb_tables:
+        print("Attempting to DELETE ALL ITEMS in '%s' DynamoDB table with %s parallel scan segments." % (table_name, segments))
+        purge_ddb_table(table_name, key_attrs, int(segments))
+
+    return
+
+@task()
+def retention(days, segments="8", intervalmins="0", cfn_params_path="config/cfn-params.json", image_processor_params_path="config/imageprocessor-params.json"):
+    '''DELETE frames and metadata older than a number of days. With intervalmins > 0, keeps running on that schedule.'''
+
+    cfn_params_dict = read_json(cfn_params_path)
+    img_processor_params_dict = read_json(image_processor_params_path)
+
+    frame_s3_bucket_name = cfn_params_dict["FrameS3BucketNameParameter"]
+    s3_roots = [img_processor_params_dict["s3_key_frames_root"], img_processor_params_dict.get("s3_key_thumbnails_root", "thumbnails/")]
+    if os.path.exists("config/framecompactor-params.json"):
+        s3_roots.append(read_json("config/framecompactor-params.json")["s3_key_archives_root"])
 
-        last_eval_key = response.get('LastEvaluatedKey', None)
-        keep_scanning = True if last_eval_key else False
+    tz = pytz.timezone(img_processor_params_dict["timezone"])
+    ddb_tables = frame_tables(img_processor_params_dict)
+    total_segments = int(segments)
+    interval_secs = float(intervalmins) * 60
 
-        with ddb_table.batch_writer() as batch:
-            for item in response["Items"]:
-                print("Deleting Item with 'frame_id': %s" % item['frame_id']['S'])
-                batch.delete_item(
-                    Key={
-                        'frame_id': item['frame_id']['S']
-                    }
-                )
-    print("Deleted %s batches of items from DynamoDB." % batch_count)
+    proceed = input("This command will DELETE frames older than %s days in S3 bucket '%s' and DynamoDB tables %s%s.\nDo you wish to continue? [Y/N] " \
+        % (days, frame_s3_bucket_name, ", ".join("'%s'" % table_name for table_name, key_attrs in ddb_tables),
+            " every %s minutes" % intervalmins if interval_secs > 0 else ""))
+
+    if(proceed.lower() != 'y'):
+        print("Aborting deletion.")
+        return
+
+    while True:
+        start_t = time.time()
+        cutoff_ts = start_t - float(days) * 24 * 60 * 60
+
+        print("Purging frames processed before %s." % datetime.datetime.fromtimestamp(cutoff_ts, tz).strftime("%Y-%m-%d %H:%M %Z"))
+
+        #Metadata goes first, so that no remaining item ever points to a deleted image
+        for table_name, key_attrs in ddb_tables:
+            purge_ddb_table(table_name, key_attrs, total_segments, cutoff_ts)
+
+        purge_s3_hours(frame_s3_bucket_name, s3_roots, cutoff_ts, tz, total_segments)
+
+        print("Retention pass completed in %d secs." % int(time.time() - start_t))
+
+        if interval_secs <= 0:
+            break
+
+        time.sleep(max(interval_secs - (time.time() - start_t), 0))
 
     return
 
+@task()
+def exportframes(outdir="exports/frames", sincedays="30", analyticsdir="analytics", framefetcher_params_path="config/framefetcher-params.json", image_processor_params_path="config/imageprocessor-params.json"):
+    '''Export frame metadata processed since the last export to Parquet files, partitioned by day and camera.'''
+
+    framefetcher_params_dict = read_json(framefetcher_params_path)
+    img_processor_params_dict = read_json(image_processor_params_path)
+
+    call(["python", os.path.join(analyticsdir, "export_frames.py"),
+        "--table", framefetcher_params_dict["ddb_table"],
+        "--gsi-name", framefetcher_params_dict["ddb_gsi_name"],
+        "--timezone", img_processor_params_dict["timezone"],
+        "--out-dir", outdir,
+        "--since-days", sincedays])
+
+    return
+
+@task()
+def reevaluatewatchlist(outdir="exports/watchlist", segments="8", since="", until="", watchlist="", minconf="", restart="", analyticsdir="analytics", image_processor_params_path="config/imageprocessor-params.json"):
+    '''Re-evaluate Watch List rules over stored frame labels, without calling Amazon Rekognition. Resumes an interrupted run.'''
+
+    args = ["--params", image_processor_params_path, "--out-dir", outdir, "--segments", segments]
+
+    if since:
+        args += ["--since", since]
+    if until:
+        args += ["--until", until]
+
+    #Labels are separated with "|", since pynt splits task parameters on commas
+    if watchlist:
+        args += ["--watch-list", watchlist.replace("|", ",")]
+    if minconf:
+        args += ["--min-conf", minconf]
+    if restart:
+        args += ["--restart"]
+
+    call(["python", os.path.join(analyticsdir, "reevaluate_watchlist.py")] + args)
+
+    return
+
+@task()
+def enrichpending(months="1", maxframes="0", concurrency="4", analyticsdir="analytics", image_processor_params_path="config/imageprocessor-params.json"):
+    '''Label frames that Image Processor stored without labels while shedding load (enrichment_pending).'''
+
+    call(["python", os.path.join(analyticsdir, "enrich_pending_frames.py"),
+        "--params", image_processor_params_path,
+        "--months", months,
+        "--max-frames", maxframes,
+        "--concurrency", concurrency])
+
+    return
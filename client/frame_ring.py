@@ -0,0 +1,81 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from multiprocessing import Array, shared_memory
+
+
+class FrameRing(object):
+    '''A ring of fixed-size frame slots in shared memory.
+
+    The capture loop writes each sampled frame into a free slot once, and hands only the slot index
+    to a worker process. The worker reads (e.g. encodes) the frame in place and releases the slot.
+    When no slot is free, acquire() returns None instead of blocking, so the capture loop never stalls
+    behind slow workers. Frames are dropped instead.
+
+    Create the ring in the capture process with FrameRing.create(), and pass attach_args() to worker
+    processes (e.g. as Pool initargs) to rebuild it there with FrameRing.attach().
+    '''
+
+    def __init__(self, shm, slot_count, slot_size, busy, lengths, owner):
+        self.shm = shm
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.busy = busy
+        self.lengths = lengths
+        self.owner = owner
+        self.next_slot = 0
+        self.dropped = 0
+
+    @classmethod
+    def create(cls, slot_count, slot_size):
+        shm = shared_memory.SharedMemory(create=True, size=slot_count * slot_size)
+        #Slot state is written by one process at a time (the capture loop sets, a worker clears), so no locks are needed
+        busy = Array('b', slot_count, lock=False)
+        lengths = Array('q', slot_count, lock=False)
+        return cls(shm, slot_count, slot_size, busy, lengths, owner=True)
+
+    def attach_args(self):
+        return (self.shm.name, self.slot_count, self.slot_size, self.busy, self.lengths)
+
+    @classmethod
+    def attach(cls, shm_name, slot_count, slot_size, busy, lengths):
+        #Worker processes share the capture process' resource tracker, so attaching does not take ownership of the block
+        return cls(shared_memory.SharedMemory(name=shm_name), slot_count, slot_size, busy, lengths, owner=False)
+
+    def acquire(self):
+        '''Returns the index of the next free slot, or None (and counts a dropped frame) if all slots are in use.'''
+        for i in range(self.slot_count):
+            slot = (self.next_slot + i) % self.slot_count
+            if not self.busy[slot]:
+                self.busy[slot] = 1
+                self.next_slot = (slot + 1) % self.slot_count
+                return slot
+
+        self.dropped += 1
+        return None
+
+    def buffer(self, slot, length=None):
+        '''Returns a writable memoryview over a slot, limited to its payload length unless length is given.'''
+        if length is None:
+            length = self.lengths[slot]
+        start = slot * self.slot_size
+        return self.shm.buf[start:start + length]
+
+    def write(self, slot, data):
+        '''Copies a bytes-like object (or a contiguous NumPy array) into a slot.'''
+        data = memoryview(data).cast('B')
+        if data.nbytes > self.slot_size:
+            raise ValueError("Frame of {} bytes does not fit in a {} bytes slot.".format(data.nbytes, self.slot_size))
+
+        self.buffer(slot, data.nbytes)[:] = data
+        self.lengths[slot] = data.nbytes
+
+    def release(self, slot):
+        self.busy[slot] = 0
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
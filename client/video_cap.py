@@ -10,31 +10,72 @@ import cv2
 import boto3
 import time
 from multiprocessing import Pool
+import numpy as np
 import pytz
 
+import frame_ring
+
 kinesis_client = boto3.client("kinesis")
 rekog_client = boto3.client("rekognition")
 
+kinesis_stream_name = "FrameStream"
 camera_index = 0 # 0 is usually the built-in webcam
+camera_id = "default" # Identifies this camera's frames downstream. Also used as the Kinesis partition key.
 capture_rate = 30 # Frame capture rate.. every X frames. Positive integer.
 rekog_max_labels = 123
 rekog_min_conf = 50.0
+ring_slots = 6 # Shared memory frame slots between the capture loop and encoder processes.
+
+#Set in encoder processes by init_ring_worker
+ring = None
+ring_frame_shape = None
+
+def now_ts_utc():
+    utc_dt = pytz.utc.localize(datetime.datetime.now())
+    return (utc_dt - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+
+def init_ring_worker(ring_args, frame_shape):
+    '''Attaches an encoder process to the capture loop's shared memory frame ring.'''
+    global ring, ring_frame_shape
+    ring = frame_ring.FrameRing.attach(*ring_args)
+    ring_frame_shape = frame_shape
+
+#Encode frame in place in its shared memory slot, then send it to Kinesis stream
+def encode_and_send_slot(slot, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False, capture_ts=None, cam_id=None):
+    try:
+        frame = np.frombuffer(ring.buffer(slot), dtype=np.uint8).reshape(ring_frame_shape)
+        retval, buff = cv2.imencode(".jpg", frame)
+    except Exception as e:
+        print(e)
+        return False
+    finally:
+        #The slot can take a new frame as soon as it is encoded
+        ring.release(slot)
+
+    return send_frame(bytearray(buff), frame_count, enable_kinesis, enable_rekog, write_file, capture_ts, cam_id)
 
 #Send frame to Kinesis stream
-def encode_and_send_frame(frame, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False):
+def encode_and_send_frame(frame, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False, capture_ts=None, cam_id=None):
     try:
         #convert opencv Mat to jpg image
         #print "----FRAME---"
         retval, buff = cv2.imencode(".jpg", frame)
+    except Exception as e:
+        print(e)
+        return False
 
-        img_bytes = bytearray(buff)
+    return send_frame(bytearray(buff), frame_count, enable_kinesis, enable_rekog, write_file, capture_ts, cam_id)
 
-        utc_dt = pytz.utc.localize(datetime.datetime.now())
-        now_ts_utc = (utc_dt - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+#Package encoded frame and send it to Kinesis stream. Returns False if it could not be sent (e.g. throttling).
+def send_frame(img_bytes, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False, capture_ts=None, cam_id=None):
+    try:
+        if capture_ts is None:
+            capture_ts = now_ts_utc()
 
         frame_package = {
-            'ApproximateCaptureTime' : now_ts_utc,
+            'ApproximateCaptureTime' : capture_ts,
             'FrameCount' : frame_count,
+            'CameraId' : cam_id or camera_id,
             'ImageBytes' : img_bytes
         }
 
@@ -48,9 +89,9 @@ def encode_and_send_frame(frame, frame_count, enable_kinesis=True, enable_rekog=
         if enable_kinesis:
             print("Sending image to Kinesis")
             response = kinesis_client.put_record(
-                StreamName="FrameStream",
+                StreamName=kinesis_stream_name,
                 Data=pickle.dumps(frame_package),
-                PartitionKey="partitionkey"
+                PartitionKey=cam_id or camera_id
             )
             print(response)
 
@@ -66,29 +107,51 @@ def encode_and_send_frame(frame, frame_count, enable_kinesis=True, enable_rekog=
 
     except Exception as e:
         print(e)
+        return False
+
+    return True
 
 
 def main():
 
     argv_len = len(sys.argv)
 
+    frame_capture_rate = capture_rate
+    cam_id = camera_id
+
     if argv_len > 1 and sys.argv[1].isdigit():
-        capture_rate = int(sys.argv[1])
+        frame_capture_rate = int(sys.argv[1])
+
+    if argv_len > 2:
+        cam_id = sys.argv[2]
 
     cap = cv2.VideoCapture(0) #Use 0 for built-in camera. Use 1, 2, etc. for attached cameras.
-    pool = Pool(processes=3)
+
+    ret, frame = cap.read()
+    if ret is False:
+        return
+
+    #Sampled frames are written once into shared memory. Only slot indices are sent to encoder processes.
+    capture_ring = frame_ring.FrameRing.create(ring_slots, frame.nbytes)
+    pool = Pool(processes=3, initializer=init_ring_worker, initargs=(capture_ring.attach_args(), frame.shape))
 
     frame_count = 0
     while True:
-        # Capture frame-by-frame
-        ret, frame = cap.read()
-        #cv2.resize(frame, (640, 360));
+        if frame_count > 0:
+            # Capture frame-by-frame
+            ret, frame = cap.read()
+            #cv2.resize(frame, (640, 360));
 
         if ret is False:
             break
 
-        if frame_count % capture_rate == 0:
-            result = pool.apply_async(encode_and_send_frame, (frame, frame_count, True, False, False,))
+        if frame_count % frame_capture_rate == 0:
+            slot = capture_ring.acquire()
+            if slot is None:
+                print("All encoder slots busy. Dropping frame {}.".format(frame_count))
+            else:
+                capture_ring.write(slot, np.ascontiguousarray(frame))
+                result = pool.apply_async(encode_and_send_slot, (slot, frame_count, True, False, False, now_ts_utc(), cam_id,))
 
         frame_count += 1
 
@@ -100,6 +163,9 @@ def main():
     # When everything done, release the capture
     cap.release()
     cv2.destroyAllWindows()
+    pool.close()
+    pool.join()
+    capture_ring.close()
     return
 
 if __name__ == '__main__':
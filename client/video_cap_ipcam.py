@@ -17,20 +17,44 @@ import code
 import time
 import pytz
 
+import frame_ring
+
 
 kinesis_client = boto3.client("kinesis")
 rekog_client = boto3.client("rekognition")
 
 #Frame capture parameters
 default_capture_rate = 30 #frame capture rate.. every X frames. Positive integer.
+default_camera_id = "ipcam" #identifies this camera's frames downstream. Also used as the Kinesis partition key.
+
+#Shared memory frame slots between the capture loop and sender processes
+ring_slots = 6
+ring_slot_bytes = 4 * 1024 * 1024 #largest JPEG frame that fits in a slot. Larger frames are passed to senders directly.
+
+#Set in sender processes by init_ring_worker
+ring = None
 
 #Rekognition paramters
 rekog_max_labels = 123
 rekog_min_conf = 50.0
 
 
+def init_ring_worker(ring_args):
+    '''Attaches a sender process to the capture loop's shared memory frame ring.'''
+    global ring
+    ring = frame_ring.FrameRing.attach(*ring_args)
+
+#Copy JPEG frame out of its shared memory slot, then send it to Kinesis stream
+def send_jpg_slot(slot, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False, cam_id=default_camera_id):
+    try:
+        frame_jpg = bytearray(ring.buffer(slot))
+    finally:
+        ring.release(slot)
+
+    send_jpg(frame_jpg, frame_count, enable_kinesis, enable_rekog, write_file, cam_id)
+
 #Send frame to Kinesis stream
-def send_jpg(frame_jpg, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False):
+def send_jpg(frame_jpg, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False, cam_id=default_camera_id):
     try:
 
         img_bytes = frame_jpg
@@ -42,6 +66,7 @@ def send_jpg(frame_jpg, frame_count, enable_kinesis=True, enable_rekog=False, wr
         frame_package = {
             'ApproximateCaptureTime' : now_ts_utc,
             'FrameCount' : frame_count,
+            'CameraId' : cam_id,
             'ImageBytes' : img_bytes
         }
 
@@ -57,7 +82,7 @@ def send_jpg(frame_jpg, frame_count, enable_kinesis=True, enable_rekog=False, wr
             response = kinesis_client.put_record(
                 StreamName="FrameStream",
                 Data=pickle.dumps(frame_package),
-                PartitionKey="partitionkey"
+                PartitionKey=cam_id
             )
             print(response)
 
@@ -79,6 +104,7 @@ def main():
 
     ip_cam_url = ''
     capture_rate = default_capture_rate
+    cam_id = default_camera_id
     argv_len = len(sys.argv)
 
     if argv_len > 1:
@@ -86,15 +112,21 @@ def main():
         
         if argv_len > 2 and sys.argv[2].isdigit():
             capture_rate = int(sys.argv[2])
+
+        if argv_len > 3:
+            cam_id = sys.argv[3]
     else:
-        print("usage: video_cap_ipcam.py <ip-cam-url> [capture-rate]")
+        print("usage: video_cap_ipcam.py <ip-cam-url> [capture-rate] [camera-id]")
         return
 
     print("Capturing from '{}' at a rate of 1 every {} frames...".format(ip_cam_url, capture_rate))
     stream = urllib.request.urlopen(ip_cam_url)
     
     bytes = b''
-    pool = Pool(processes=3)
+
+    #Sampled frames are written once into shared memory. Only slot indices are sent to sender processes.
+    capture_ring = frame_ring.FrameRing.create(ring_slots, ring_slot_bytes)
+    pool = Pool(processes=3, initializer=init_ring_worker, initargs=(capture_ring.attach_args(),))
 
     frame_count = 0
     while True:
@@ -125,7 +157,15 @@ def main():
                 retval, new_frame_jpg_bytes = cv2.imencode(".jpg", rotated_img)
 
                 #Send to Kinesis
-                result = pool.apply_async(send_jpg, (bytearray(new_frame_jpg_bytes), frame_count, True, False, False,))
+                if new_frame_jpg_bytes.nbytes > ring_slot_bytes:
+                    result = pool.apply_async(send_jpg, (bytearray(new_frame_jpg_bytes), frame_count, True, False, False, cam_id,))
+                else:
+                    slot = capture_ring.acquire()
+                    if slot is None:
+                        print("All sender slots busy. Dropping frame {}.".format(frame_count))
+                    else:
+                        capture_ring.write(slot, new_frame_jpg_bytes)
+                        result = pool.apply_async(send_jpg_slot, (slot, frame_count, True, False, False, cam_id,))
 
             frame_count += 1
 
@@ -0,0 +1,177 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+import argparse
+import os
+import time
+import cv2
+import boto3
+from multiprocessing import Pool
+
+import video_cap
+
+#Replay parameters
+default_capture_rate = 30 #frame capture rate.. every X frames. Positive integer.
+default_workers = 4
+default_fallback_fps = 30.0 #used when a video file does not report its frame rate
+start_lead_secs = 2.0 #gives worker processes time to open and seek their files before pacing starts
+
+
+def init_worker(endpoint_url, stream_name):
+    '''Points the shared producer path at the configured Kinesis endpoint and stream.'''
+    if endpoint_url:
+        video_cap.kinesis_client = boto3.client("kinesis", endpoint_url=endpoint_url)
+
+    video_cap.kinesis_stream_name = stream_name
+
+
+def probe_video(video_path):
+    '''Returns (frame count, fps) of a video file.'''
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError("Could not open video file '{}'".format(video_path))
+
+    frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or default_fallback_fps
+    cap.release()
+
+    return frame_total, fps
+
+
+def split_ranges(frame_total, range_count, capture_rate):
+    '''Splits [0, frame_total) into contiguous seek ranges whose boundaries fall on sampled frames.'''
+    sampled_total = (frame_total + capture_rate - 1) // capture_rate
+    range_count = max(1, min(range_count, sampled_total))
+    per_range = max(1, (sampled_total + range_count - 1) // range_count)
+
+    ranges = []
+    for i in range(0, sampled_total, per_range):
+        start = i * capture_rate
+        end = min((i + per_range) * capture_rate, frame_total)
+        ranges.append((start, end))
+
+    return ranges
+
+
+def replay_range(video_path, cam_id, start_frame, end_frame, fps, capture_rate, video_start_ts, replay_start_wall, speed, enable_kinesis):
+    '''Decodes one seek range of a video file and sends every sampled frame, paced against the shared replay clock.
+
+    A speed of 0 sends frames as fast as they can be decoded. Returns (frames sent, frames behind schedule, frames that failed to send).
+    '''
+    cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+    sent_count = 0
+    late_count = 0
+    failed_count = 0
+    for frame_count in range(start_frame, end_frame):
+
+        if frame_count % capture_rate != 0:
+            #grab() advances without decoding the frame
+            if not cap.grab():
+                break
+            continue
+
+        ret, frame = cap.read()
+        if ret is False:
+            break
+
+        video_offset = frame_count / fps
+
+        if speed > 0:
+            delay = replay_start_wall + video_offset / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                late_count += 1
+
+        #Original capture time is preserved, regardless of replay speed
+        if video_cap.encode_and_send_frame(frame, frame_count, enable_kinesis, False, False, capture_ts=video_start_ts + video_offset, cam_id=cam_id):
+            sent_count += 1
+        else:
+            failed_count += 1
+
+    cap.release()
+
+    return sent_count, late_count, failed_count
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Replay recorded video files into the frame stream.")
+    parser.add_argument("videos", nargs="+", help="video files to replay")
+    parser.add_argument("--speed", type=float, default=1.0,
+        help="replay speed as a multiple of real time. 0 replays as fast as possible. Default is 1 (real time).")
+    parser.add_argument("--capture-rate", type=int, default=default_capture_rate,
+        help="send 1 every X frames. Default is {}.".format(default_capture_rate))
+    parser.add_argument("--workers", type=int, default=default_workers,
+        help="number of decoding processes, shared among all files (at least one per file). Default is {}.".format(default_workers))
+    parser.add_argument("--start-time", type=float, default=None,
+        help="capture time (epoch seconds) of the first frame of every file. Default is the file's modification time minus its duration.")
+    parser.add_argument("--camera-id", default=None,
+        help="camera id of every file's frames. Default is the file's name without extension, so every file replays as its own camera.")
+    parser.add_argument("--endpoint-url", default="",
+        help="Kinesis endpoint URL, e.g. of a local Kinesis stand-in such as kinesalite or LocalStack.")
+    parser.add_argument("--stream-name", default=video_cap.kinesis_stream_name,
+        help="Kinesis stream name. Default is '{}'.".format(video_cap.kinesis_stream_name))
+    parser.add_argument("--no-kinesis", action="store_true",
+        help="decode and encode frames without sending them. Useful to measure client-side throughput.")
+    args = parser.parse_args()
+
+    capture_rate = max(1, args.capture_rate)
+    workers = max(1, args.workers)
+
+    replay_start_wall = time.time() + start_lead_secs
+
+    #Split every file into seek ranges so that all worker processes decode in parallel.
+    #Every range gets its own process, so that paced ranges never wait behind one another.
+    ranges_per_video = max(1, workers // len(args.videos))
+
+    tasks = []
+    for video_path in args.videos:
+        frame_total, fps = probe_video(video_path)
+        if frame_total <= 0:
+            #e.g. an empty file, or a container that does not report its frame count
+            print("Skipping '{}': it reports no frames.".format(video_path))
+            continue
+
+        duration = frame_total / fps
+
+        if args.start_time is not None:
+            video_start_ts = args.start_time
+        else:
+            video_start_ts = os.path.getmtime(video_path) - duration
+
+        cam_id = args.camera_id or os.path.splitext(os.path.basename(video_path))[0]
+
+        ranges = split_ranges(frame_total, ranges_per_video, capture_rate)
+
+        print("Replaying '{}': {} frames at {:.2f} fps ({:.1f} secs) in {} ranges.".format(
+            video_path, frame_total, fps, duration, len(ranges)))
+
+        for start_frame, end_frame in ranges:
+            tasks.append((video_path, cam_id, start_frame, end_frame, fps, capture_rate,
+                video_start_ts, replay_start_wall, args.speed, not args.no_kinesis))
+
+    if not tasks:
+        print("Nothing to replay.")
+        return
+
+    pool = Pool(processes=len(tasks), initializer=init_worker, initargs=(args.endpoint_url, args.stream_name))
+    results = pool.starmap(replay_range, tasks)
+    pool.close()
+    pool.join()
+
+    sent_total = sum(sent for sent, late, failed in results)
+    late_total = sum(late for sent, late, failed in results)
+    failed_total = sum(failed for sent, late, failed in results)
+    elapsed = max(time.time() - replay_start_wall, 1e-6)
+
+    print("Sent {} frames in {:.1f} secs ({:.1f} frames/sec). {} frames were behind schedule. {} frames failed to send (e.g. Kinesis throttling).".format(
+        sent_total, elapsed, sent_total / elapsed, late_total, failed_total))
+
+
+if __name__ == '__main__':
+    main()
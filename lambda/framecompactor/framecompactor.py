@@ -0,0 +1,245 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import datetime
+import json
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.exceptions import ClientError
+import pytz
+from pytz import timezone
+
+# Frame archive layout (all integers big-endian):
+#
+#   header  : magic (4s) | version (H) | reserved (H) | frame count (I)
+#   index   : one entry per frame -- frame_id (36s) | offset (Q) | length (I)
+#   payload : the frames' JPEG bytes, concatenated in index order
+#
+# Offsets are absolute from the start of the archive, so a single frame can be
+# read back with one ranged S3 GET.
+ARCHIVE_MAGIC = b'VFAR'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct('>4sHHI')
+ARCHIVE_INDEX_ENTRY = struct.Struct('>36sQI')
+
+MIN_MULTIPART_PART_SIZE = 5 * 1024 * 1024 #S3 minimum for all but the last part
+S3_DELETE_BATCH_SIZE = 1000 #S3 maximum keys per delete_objects call
+
+def load_config():
+    '''Load configuration from file.'''
+    with open('framecompactor-params.json', 'r') as conf_file:
+        conf_json = conf_file.read()
+        return json.loads(conf_json)
+
+def closed_hour_prefix(config):
+    '''Returns the YYYY/MM/DD/HH path of the most recent hour that Image Processor no longer writes to.'''
+    tz = timezone(config['timezone'])
+    delay_mins = float(config.get('compaction_delay_mins', 10))
+
+    utc_dt = pytz.utc.localize(datetime.datetime.utcnow())
+    closed_dt = (utc_dt - datetime.timedelta(hours=1, minutes=delay_mins)).astimezone(tz)
+
+    return closed_dt.strftime('%Y/%m/%d/%H')
+
+def list_hour_frames(s3_client, s3_bucket, prefix):
+    '''Lists (key, size) of all frame images under an hour prefix, without downloading them.'''
+    frames = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.jpg'):
+                frames.append((obj['Key'], obj['Size']))
+
+    return frames
+
+def frame_id_from_key(s3_key):
+    '''Image Processor names frame images after their frame_id.'''
+    return s3_key.rsplit('/', 1)[-1][:-len('.jpg')]
+
+def build_archive_index(frames):
+    '''Builds the archive header and index. Returns (header bytes, list of (frame_id, s3_key, offset, length)).'''
+    entries = []
+    offset = ARCHIVE_HEADER.size + ARCHIVE_INDEX_ENTRY.size * len(frames)
+
+    index_bytes = bytearray()
+    for s3_key, size in frames:
+        frame_id = frame_id_from_key(s3_key)
+        index_bytes += ARCHIVE_INDEX_ENTRY.pack(frame_id.encode('ascii'), offset, size)
+        entries.append((frame_id, s3_key, offset, size))
+        offset += size
+
+    header = ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, len(frames)) + bytes(index_bytes)
+
+    return header, entries
+
+class MultipartWriter(object):
+    '''Streams bytes into an S3 multipart upload, holding at most one part in memory.'''
+
+    def __init__(self, s3_client, s3_bucket, s3_key, part_size):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.part_size = max(part_size, MIN_MULTIPART_PART_SIZE)
+        self.buff = bytearray()
+        self.parts = []
+
+        response = s3_client.create_multipart_upload(
+            Bucket=s3_bucket,
+            Key=s3_key,
+            ContentType='application/octet-stream'
+        )
+        self.upload_id = response['UploadId']
+
+    def write(self, data):
+        self.buff += data
+        if len(self.buff) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        part_num = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.s3_bucket,
+            Key=self.s3_key,
+            UploadId=self.upload_id,
+            PartNumber=part_num,
+            Body=bytes(self.buff)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_num})
+        self.buff = bytearray()
+
+    def complete(self):
+        if self.buff or not self.parts:
+            self._upload_part()
+
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.s3_bucket,
+            Key=self.s3_key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.s3_bucket,
+            Key=self.s3_key,
+            UploadId=self.upload_id
+        )
+
+def compact_hour(hour_path, config, s3_client, ddb_table):
+    '''Packs all frame images of one hour into a single indexed archive. Returns the number of frames compacted.'''
+    s3_bucket = config['s3_bucket']
+    s3_key_frames_root = config['s3_key_frames_root']
+    s3_key_archives_root = config['s3_key_archives_root']
+    fetch_concurrency = int(config.get('fetch_concurrency', 16))
+    part_size = int(config.get('multipart_part_size_mb', 8)) * 1024 * 1024
+
+    s3_key_thumbnails_root = config.get('s3_key_thumbnails_root', 'thumbnails/')
+
+    frames = list_hour_frames(s3_client, s3_bucket, s3_key_frames_root + hour_path + '/')
+
+    #The Web UI shows thumbnails through pre-signed S3 URLs, which cannot address a byte range. So thumbnails
+    #stay one object per frame, and only full-size frames are compacted. A frame without a thumbnail is shown
+    #from its original image, so it is left in place (e.g. all frames, if Image Processor is deployed without Pillow).
+    thumbnail_ids = set(frame_id_from_key(s3_key) for s3_key, size in
+        list_hour_frames(s3_client, s3_bucket, s3_key_thumbnails_root + hour_path + '/'))
+    skipped_count = len(frames)
+    frames = [(s3_key, size) for s3_key, size in frames if frame_id_from_key(s3_key) in thumbnail_ids]
+    skipped_count -= len(frames)
+
+    if skipped_count:
+        print('Leaving {} frames of hour {} uncompacted, since they have no thumbnail.'.format(skipped_count, hour_path))
+
+    if not frames:
+        print('No frames to compact for hour {}.'.format(hour_path))
+        return 0
+
+    #Sizes are known from the listing, so the index can be written before any frame is downloaded.
+    header, entries = build_archive_index(frames)
+
+    #A unique suffix keeps re-runs over the same hour from overwriting an archive that items already point to.
+    archive_key = '{}{}-{}.vfa'.format(s3_key_archives_root, hour_path, uuid.uuid4().hex[:8])
+
+    print('Compacting {} frames of hour {} into {}'.format(len(entries), hour_path, archive_key))
+
+    def fetch_frame(entry):
+        frame_id, s3_key, offset, length = entry
+        body = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)['Body'].read()
+        if len(body) != length:
+            raise ValueError('Frame {} changed size while being compacted.'.format(s3_key))
+        return body
+
+    writer = MultipartWriter(s3_client, s3_bucket, archive_key, part_size)
+    try:
+        writer.write(header)
+
+        #Frames are fetched concurrently in small windows, so memory stays bounded by window size, not hour size.
+        with ThreadPoolExecutor(max_workers=fetch_concurrency) as executor:
+            for i in range(0, len(entries), fetch_concurrency):
+                for body in executor.map(fetch_frame, entries[i:i + fetch_concurrency]):
+                    writer.write(body)
+
+        writer.complete()
+    except Exception:
+        writer.abort()
+        raise
+
+    #Point frame metadata at the archive before deleting the original objects.
+    compacted_keys = []
+    for frame_id, s3_key, offset, length in entries:
+        try:
+            ddb_table.update_item(
+                Key={'frame_id': frame_id},
+                UpdateExpression='SET archive_s3_key = :k, archive_offset = :o, archive_length = :l',
+                ConditionExpression='attribute_exists(frame_id)',
+                ExpressionAttributeValues={
+                    ':k': archive_key,
+                    ':o': offset,
+                    ':l': length
+                }
+            )
+            compacted_keys.append(s3_key)
+        except ClientError as e:
+            #Leave the original object in place; it will be picked up by the next run over this hour.
+            print('Could not update frame {}: {}'.format(frame_id, e.response['Error']['Message']))
+
+    for i in range(0, len(compacted_keys), S3_DELETE_BATCH_SIZE):
+        s3_client.delete_objects(
+            Bucket=s3_bucket,
+            Delete={
+                'Objects': [{'Key': key} for key in compacted_keys[i:i + S3_DELETE_BATCH_SIZE]],
+                'Quiet': True
+            }
+        )
+
+    return len(compacted_keys)
+
+def compact_frames(event, context):
+
+    #Initialize clients
+    s3_client = boto3.client('s3')
+    dynamodb = boto3.resource('dynamodb')
+
+    #Load config
+    config = load_config()
+
+    ddb_table = dynamodb.Table(config['ddb_table'])
+
+    #Scheduled invocations compact the last closed hour. Pass {"hour": "YYYY/MM/DD/HH"} to backfill a specific hour.
+    hour_path = (event or {}).get('hour') or closed_hour_prefix(config)
+
+    start_t = time.time()
+    frame_count = compact_hour(hour_path, config, s3_client, ddb_table)
+
+    print('Compacted {} frames of hour {} in {:.1f} secs.'.format(frame_count, hour_path, time.time() - start_t))
+
+    return {'hour': hour_path, 'frame_count': frame_count}
+
+def handler(event, context):
+    return compact_frames(event, context)
@@ -5,23 +5,21 @@
 
 from __future__ import print_function
 
+import base64
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
 import datetime
 import time
 import json
 import decimal
+import threading
 from datetime import timedelta
+import serializer
 
+#Clients are created once per container, and reused by every invocation it serves
+dynamodb = boto3.resource('dynamodb')
+s3_client = boto3.client('s3')
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o): # pylint: disable=E0202
-        if isinstance(o, decimal.Decimal):
-            if o % 1 > 0:
-                return float(o)
-            else:
-                return int(o)
-        return super(DecimalEncoder, self).default(o)
 
 def load_config():
 
@@ -29,10 +27,28 @@ def load_config():
         conf_json = conf_file.read()
         return json.loads(conf_json)
 
+def read_archived_frame(s3_client, item):
+    '''Reads a compacted frame's JPEG bytes from its hourly archive with a single ranged GET.'''
+    first_byte = int(item['archive_offset'])
+    last_byte = first_byte + int(item['archive_length']) - 1
+
+    response = s3_client.get_object(
+        Bucket=item['s3_bucket'],
+        Key=item['archive_s3_key'],
+        Range='bytes={}-{}'.format(first_byte, last_byte)
+    )
+
+    return response['Body'].read()
+
 def respond(err, res=None):
+    if err:
+        return respond_body(str(err), '400')
+    return respond_body(serializer.to_json(res))
+
+def respond_body(body, status_code='200'):
     return {
-        'statusCode': '400' if err else '200',
-        'body': err.message if err else json.dumps(res, cls=DecimalEncoder),
+        'statusCode': status_code,
+        'body': body,
         'headers': {
             'Content-Type': 'application/json',
             'Access-Control-Allow-Origin': "*"
@@ -40,63 +56,313 @@ def respond(err, res=None):
     }
 
 
-def fetch_frames(event, context):
+def respond_image(img_bytes):
+    '''A single JPEG response. API Gateway decodes the body, since the API treats every media type as binary.'''
+    return {
+        'statusCode': '200',
+        'body': base64.b64encode(img_bytes).decode('ascii'),
+        'isBase64Encoded': True,
+        'headers': {
+            'Content-Type': 'image/jpeg',
+            'Access-Control-Allow-Origin': "*"
+        },
+    }
 
-    #Initialize clients
-    dynamodb = boto3.resource('dynamodb')
-    s3_client = boto3.client('s3')
-    
-    #Load config
-    config = load_config()
+def frame_url_base(event):
+    '''The URL of this API resource, as called by the client. Relative if API Gateway did not pass the domain.'''
+    request_context = event.get('requestContext') or {}
+    path = event.get('path') or ''
+
+    if request_context.get('domainName') and request_context.get('stage'):
+        return 'https://{}/{}{}'.format(request_context['domainName'], request_context['stage'], path)
+
+    return path
+
+def add_image_urls(s3_client, items, full_size, config, url_base):
+    '''Adds an "s3_presigned_url" attribute to every frame item, pointing to its thumbnail or full-size image.
+
+    Images that only Frame Fetcher can read get a "frame_api_url" attribute instead. Unlike a pre-signed URL,
+    it cannot be used as is (e.g. as an image source), since requests to it must carry the API key.
+    '''
+    for item in items:
+
+        #Frames stored before thumbnails were introduced only have a full-size image.
+        has_thumbnail = 's3_thumbnail_key' in item
+
+        #The full-size images of compacted frames live inside an hourly archive. Point to the "?frame_id=" endpoint,
+        #which reads a single frame with a ranged GET. Frame Compactor only compacts frames that have a thumbnail.
+        if 'archive_s3_key' in item and (full_size or not has_thumbnail):
+            item['frame_api_url'] = '{}?frame_id={}'.format(url_base, item['frame_id'])
+            continue
+
+        s3_key = item["s3_thumbnail_key"] if has_thumbnail and not full_size else item["s3_key"]
+        s3_bucket = item["s3_bucket"]
+        # Note the following. 
+        # (1) even if the url expires in days or weeks, the presigned 
+        # url is usable only if the temporary IAM credentials that generated 
+        # it haven't expired. These are the credentials assumed by this lambda function.
+        # (2) Your bucket policy needs to allow "read" access to "authenticated AWS users"
+        # (3) Ensure this Lambda function's role has S3FullAccess policy attached to it. 
+        s3_presigned_url_expiry = config["s3_pre_signed_url_expiry"]
+
+        s3_presigned_url = s3_client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={
+                'Bucket' : s3_bucket,
+                'Key' : s3_key
+            },
+            ExpiresIn=s3_presigned_url_expiry
+        )
+
+        item['s3_presigned_url'] = s3_presigned_url
+
+def label_bucket(label, ts):
+    '''Label index partition key. Must match the one written by Image Processor: upper-cased label and UTC hour.'''
+    return '{}#{}'.format(label.upper(), time.strftime('%Y%m%d%H', time.gmtime(ts)))
+
+def query_frames_by_label(query_params, config, dynamodb, s3_client, full_size, url_base):
+    '''Returns frames with one or more labels, one time window at a time, using the label index.
+
+    Hourly buckets are read newest first, one small query per label each, and reading stops as soon as a page
+    of frames is collected. So cost depends on the number of frames returned, never on the size of the frames table.
+    '''
+    label_index_table = dynamodb.Table(config['ddb_label_index_table'])
+
+    labels = [label.strip() for label in query_params['labels'].split(',') if label.strip()]
+    match_all = query_params.get('match', 'any') == 'all'
+    min_conf = float(query_params.get('min_conf', 0))
+    window_hrs = min(float(query_params.get('window_hrs', config['label_query_window_hrs'])), float(config['label_query_max_window_hrs']))
+    window_end = float(query_params.get('before', time.time()))
+    window_start = window_end - window_hrs * 60 * 60
+    max_frames = int(config['label_query_max_frames'])
+    wanted = set(label.upper() for label in labels)
+
+    #Processed timestamp, frame id of matching frames, most recent first
+    found = []
+    next_before = window_start
+
+    #The bucket of the last second before window_end
+    bucket_ts = (window_end - 1) - ((window_end - 1) % 3600)
+    while bucket_ts + 3600 > window_start:
+
+        #Frame id -> labels matched, and processed timestamp. A frame's labels are all in the same hourly bucket.
+        matches = {}
+        for label in labels:
+            query_kwargs = {
+                'KeyConditionExpression': Key('label_bucket').eq(label_bucket(label, bucket_ts))
+                    & Key('conf_frame').gte('{:06.2f}'.format(min_conf)),
+                'ProjectionExpression': 'frame_id, processed_timestamp'
+            }
+
+            while True:
+                ddb_resp = label_index_table.query(**query_kwargs)
+
+                for entry in ddb_resp['Items']:
+                    if window_start <= entry['processed_timestamp'] < window_end:
+                        match = matches.setdefault(entry['frame_id'], {'labels': set(), 'ts': entry['processed_timestamp']})
+                        match['labels'].add(label.upper())
+
+                if 'LastEvaluatedKey' not in ddb_resp:
+                    break
+                query_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+        found.extend(sorted(((match['ts'], frame_id) for frame_id, match in matches.items()
+            if not match_all or match['labels'] >= wanted), reverse=True))
+
+        #Once a page is collected, the next page starts where this one stopped: within this bucket, or before it.
+        if len(found) >= max_frames:
+            next_before = float(found[max_frames - 1][0]) if len(found) > max_frames else max(bucket_ts, window_start)
+            found = found[:max_frames]
+            break
+
+        bucket_ts -= 3600
+
+    frame_ids = [frame_id for ts, frame_id in found]
+
+    items = []
+    for i in range(0, len(frame_ids), 100): #BatchGetItem maximum
+        request = {config['ddb_table']: {'Keys': [{'frame_id': frame_id} for frame_id in frame_ids[i:i + 100]]}}
+        while request:
+            ddb_resp = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(ddb_resp['Responses'].get(config['ddb_table'], []))
+            request = ddb_resp.get('UnprocessedKeys')
+
+    items.sort(key=lambda item: item['processed_timestamp'], reverse=True)
+
+    add_image_urls(s3_client, items, full_size, config, url_base)
+
+    return {
+        'frames': items,
+        'next_before': next_before
+    }
+
+def fetch_frame_image(frame_id, config, dynamodb, s3_client):
+    '''Returns the full-size JPEG bytes of one frame, or None if there is no such frame.'''
+    ddb_table = dynamodb.Table(config['ddb_table'])
+
+    item = ddb_table.get_item(Key={'frame_id': frame_id}).get('Item')
+    if item is None:
+        return None
+
+    if 'archive_s3_key' in item:
+        return read_archived_frame(s3_client, item)
+
+    return s3_client.get_object(Bucket=item['s3_bucket'], Key=item['s3_key'])['Body'].read()
+
+def fetch_rollup(query_params, config, dynamodb):
+    '''Returns a time series of per-minute or per-hour counters of one label, maintained by Image Processor.
+
+    Counters are bucketed by frame capture time. Use camera "*" (the default) for all cameras combined.
+    The time range is capped per granularity, so that a response stays well within the Lambda response size limit.
+    '''
+    rollup_table = dynamodb.Table(config['ddb_rollup_table'])
+
+    label = query_params['rollup']
+    camera_id = query_params.get('camera', '*')
+    granularity = 'm' if query_params.get('granularity', 'hour') == 'minute' else 'h'
+
+    end_ts = float(query_params.get('end', time.time()))
+    start_ts = float(query_params.get('start', end_ts - float(config['rollup_default_window_hrs']) * 60 * 60))
+
+    max_window_hrs = float(config['rollup_max_window_hrs_minute' if granularity == 'm' else 'rollup_max_window_hrs_hour'])
+    start_ts = max(start_ts, end_ts - max_window_hrs * 60 * 60)
+
+    query_kwargs = {
+        'KeyConditionExpression': Key('rollup_key').eq('{}#{}#{}'.format(label.upper(), camera_id, granularity))
+            & Key('bucket_ts').between(decimal.Decimal(int(start_ts)), decimal.Decimal(int(end_ts))),
+        'ProjectionExpression': 'bucket_ts, frame_count, instance_count'
+    }
+
+    series = []
+    while True:
+        ddb_resp = rollup_table.query(**query_kwargs)
+        series.extend(ddb_resp['Items'])
+
+        if 'LastEvaluatedKey' not in ddb_resp:
+            break
+        query_kwargs['ExclusiveStartKey'] = ddb_resp['LastEvaluatedKey']
+
+    return {
+        'label': label,
+        'camera': camera_id,
+        'granularity': 'minute' if granularity == 'm' else 'hour',
+        'start': int(start_ts),
+        'end': int(end_ts),
+        'series': series
+    }
+
+class HotWindowCache(object):
+    '''The most recent frames window, shared by all requests served by this container.
+
+    Every open Web UI polls for the latest frames every few seconds. Within the TTL, polls are served
+    from memory, including the serialized response body. Once the window is stale, the first request
+    refreshes it with a single DynamoDB query. Concurrent requests wait for that query to complete
+    instead of issuing their own.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetched_at = None
+        self.items = None
+        self.bodies = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_body(self, full_size, ttl_secs, query_items, render_body):
+        '''Returns the response body for the thumbnail (or full-size) view of the window, and whether it was a cache hit.'''
+        with self.lock:
+            now = time.time()
+            hit = self.fetched_at is not None and now - self.fetched_at < ttl_secs
+
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.items = query_items()
+                self.fetched_at = now
+                self.bodies = {}
+
+            #Both views share one query. Each gets its own copy of the items, since image URLs are added in place.
+            if full_size not in self.bodies:
+                self.bodies[full_size] = render_body([dict(item) for item in self.items], full_size)
 
+            return self.bodies[full_size], hit
+
+hot_window_cache = HotWindowCache()
+
+def query_latest_frames(config):
+    '''Returns the most recent frames within the fetch horizon, most recent first.'''
     ddb_table = dynamodb.Table(config['ddb_table'])
     ddb_gsi_name = config['ddb_gsi_name']
     fetch_horizon_hrs = float(config['fetch_horizon_hrs'])
     fetch_limit = config['fetch_limit']
 
+    now = datetime.datetime.now()
+    year = now.strftime("%Y")
+    mon = now.strftime("%m")
+
+    ts_at_fetch_horizon = time.time() - (fetch_horizon_hrs * 60 * 60)
+
+    ddb_resp = ddb_table.query(
+        IndexName=ddb_gsi_name,
+        
+        KeyConditionExpression=Key('processed_year_month').eq(year + mon) 
+        & Key('processed_timestamp').gt(decimal.Decimal(ts_at_fetch_horizon)),
+        Limit=fetch_limit,
+        ScanIndexForward=False #Sort descendingly -- show most recent captured frames first.
+    )
+
+    #Log a summary only. Printing the whole response costs about as much as serializing it.
+    print('Fetched {} frames.'.format(ddb_resp['Count']))
+
+    return ddb_resp["Items"]
+
+def fetch_frames(event, context):
+
+    #Load config
+    config = load_config()
+
     #Process "GET" request
     if event['httpMethod'] == "GET":
-        now = datetime.datetime.now()
-        year = now.strftime("%Y")
-        mon = now.strftime("%m")
-
-        ts_at_fetch_horizon = time.time() - (fetch_horizon_hrs * 60 * 60)
-
-        ddb_resp = ddb_table.query(
-            IndexName=ddb_gsi_name,
-            
-            KeyConditionExpression=Key('processed_year_month').eq(year + mon) 
-            & Key('processed_timestamp').gt(decimal.Decimal(ts_at_fetch_horizon)),
-            Limit=fetch_limit,
-            ScanIndexForward=False #Sort descendingly -- show most recent captured frames first.
-        )
+        query_params = event.get('queryStringParameters') or {}
 
-        for item in ddb_resp["Items"]:
-
-            s3_key = item["s3_key"]
-            s3_bucket = item["s3_bucket"]
-            # Note the following. 
-            # (1) even if the url expires in days or weeks, the presigned 
-            # url is usable only if the temporary IAM credentials that generated 
-            # it haven't expired. These are the credentials assumed by this lambda function.
-            # (2) Your bucket policy needs to allow "read" access to "authenticated AWS users"
-            # (3) Ensure this Lambda function's role has S3FullAccess policy attached to it. 
-            s3_presigned_url_expiry = config["s3_pre_signed_url_expiry"]
-
-            s3_presigned_url = s3_client.generate_presigned_url(
-                ClientMethod='get_object',
-                Params={
-                    'Bucket' : s3_bucket,
-                    'Key' : s3_key
-                },
-                ExpiresIn=s3_presigned_url_expiry
-            )
-
-            item['s3_presigned_url'] = s3_presigned_url
-        
-        print (ddb_resp)
+        #Thumbnails are returned by default. Pass "?image_size=full" for full-size frame images.
+        full_size = query_params.get('image_size', 'thumbnail') == 'full'
+
+        #"?frame_id=..." returns the full-size JPEG image of a single frame, e.g. a compacted one
+        if query_params.get('frame_id'):
+            img_bytes = fetch_frame_image(query_params['frame_id'], config, dynamodb, s3_client)
+            if img_bytes is None:
+                return respond_body('Frame not found.', '404')
+            return respond_image(img_bytes)
+
+        url_base = frame_url_base(event)
+
+        #"?rollup=Person" returns label counters over time instead of frames
+        if query_params.get('rollup'):
+            try:
+                return respond(None, fetch_rollup(query_params, config, dynamodb))
+            except ValueError as e:
+                return respond(e)
+
+        #"?labels=Dog,Cat" switches to querying frames by label through the label index
+        if query_params.get('labels'):
+            try:
+                return respond(None, query_frames_by_label(query_params, config, dynamodb, s3_client, full_size, url_base))
+            except ValueError as e:
+                return respond(e)
+
+        def render_body(items, full_size):
+            add_image_urls(s3_client, items, full_size, config, url_base)
+            return serializer.to_json(items)
+
+        body, hit = hot_window_cache.get_body(
+            full_size, float(config['hot_cache_ttl_secs']), lambda: query_latest_frames(config), render_body)
+
+        print('Hot window cache {}. {} hits, {} misses since container start.'.format(
+            'hit' if hit else 'miss', hot_window_cache.hits, hot_window_cache.misses))
 
-        return respond(None, ddb_resp["Items"])
+        return respond_body(body)
 
 def handler(event, context):
     return fetch_frames(event, context)
@@ -0,0 +1,41 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import json
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    #orjson is optional. Without it, the standard library encoder is used.
+    orjson = None
+
+def to_number(o):
+    '''JSON encoder hook: converts a DynamoDB number to an int if it is integral, else to a float.
+
+    Encoders only call it for values they cannot serialize natively, so plain strings, lists and
+    dicts of a DynamoDB item never go through Python code.
+    '''
+    if isinstance(o, Decimal):
+        f = float(o)
+        if f.is_integer():
+            #int() of the Decimal itself, since floats no longer hold every integer exactly beyond 2**53
+            return int(o)
+        return f
+    if isinstance(o, (set, frozenset)):
+        #DynamoDB number and string sets
+        return list(o)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(o).__name__))
+
+def to_json(o):
+    '''Serializes DynamoDB items to compact JSON text, with orjson if it is installed.'''
+    if orjson is not None:
+        try:
+            return orjson.dumps(o, default=to_number).decode('utf-8')
+        except TypeError:
+            #e.g. integers beyond 64 bits, which only the standard library encoder handles
+            pass
+    return json.dumps(o, default=to_number, separators=(',', ':'), check_circular=False)
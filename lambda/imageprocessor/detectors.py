@@ -0,0 +1,169 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    #OpenCV is optional. Without it, only the Rekognition backend is available.
+    cv2 = None
+
+# Every detector returns a dict shaped like an Amazon Rekognition DetectLabels response:
+#
+#   {'Labels': [{'Name': 'Person', 'Confidence': 97.1, 'Parents': [],
+#                'Instances': [{'BoundingBox': {'Width': .., 'Height': .., 'Left': .., 'Top': ..}, 'Confidence': 97.1}]}],
+#    'Detector': 'opencv'}
+#
+# Confidences are percentages, and bounding boxes are ratios of the frame's width and height.
+# "Detector" names the backend whose labels were returned.
+
+class RekognitionDetector(object):
+    '''Labels frames with Amazon Rekognition DetectLabels.'''
+
+    name = 'rekognition'
+
+    def __init__(self, rekog_client, max_labels, min_conf):
+        self.rekog_client = rekog_client
+        self.max_labels = max_labels
+        self.min_conf = min_conf
+
+    def detect(self, img_bytes):
+        response = self.rekog_client.detect_labels(
+            Image={
+                'Bytes': img_bytes
+            },
+            MaxLabels=self.max_labels,
+            MinConfidence=self.min_conf
+        )
+        response['Detector'] = self.name
+        return response
+
+#Loaded networks, by model path. Loading takes much longer than a detection, so it is done once per container.
+nets = {}
+
+def load_net(model_path, model_config_path):
+    if model_path not in nets:
+        if cv2 is None:
+            raise RuntimeError("The 'opencv' detector backend requires OpenCV (cv2) and NumPy to be packaged with the function.")
+        #Runs on the CPU, OpenCV's default target
+        nets[model_path] = cv2.dnn.readNet(model_path, model_config_path or '')
+    return nets[model_path]
+
+class OpenCVDetector(object):
+    '''Labels frames on the CPU with an SSD object detection network, run by the OpenCV DNN module.
+
+    Any SSD network that OpenCV can read, and whose output is the usual [1, 1, N, 7] detections blob
+    (image id, class id, confidence, left, top, right, bottom), can be used. E.g. MobileNet-SSD (Caffe)
+    or SSD MobileNet (TensorFlow). class_names maps class ids to label names, and should use
+    Rekognition's names so that labels line up in queries, counters, and the Watch List.
+    '''
+
+    name = 'opencv'
+
+    def __init__(self, model_path, model_config_path, class_names, min_conf,
+                 input_size=300, input_scale=1.0, input_mean=0.0, input_swap_rb=False):
+        self.net = load_net(model_path, model_config_path)
+        self.class_names = class_names
+        self.min_conf = min_conf
+        self.input_size = input_size
+        self.input_scale = input_scale
+        self.input_mean = input_mean
+        self.input_swap_rb = input_swap_rb
+
+    def detect(self, img_bytes):
+        img = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Could not decode frame image.")
+
+        blob = cv2.dnn.blobFromImage(img, self.input_scale, (self.input_size, self.input_size),
+            (self.input_mean, self.input_mean, self.input_mean), swapRB=self.input_swap_rb, crop=False)
+        self.net.setInput(blob)
+        detections = self.net.forward().reshape(-1, 7)
+
+        #Label name -> label, in order of first (i.e. most confident) detection
+        labels = {}
+        for _, class_id, conf, left, top, right, bottom in detections[np.argsort(-detections[:, 2])]:
+            conf = float(conf) * 100
+            class_id = int(class_id)
+            if conf < self.min_conf or not 0 < class_id < len(self.class_names):
+                continue
+
+            left, top = max(0.0, float(left)), max(0.0, float(top))
+            right, bottom = min(1.0, float(right)), min(1.0, float(bottom))
+            if right <= left or bottom <= top:
+                continue
+
+            name = self.class_names[class_id]
+            if name not in labels:
+                labels[name] = {'Name': name, 'Confidence': conf, 'Instances': [], 'Parents': []}
+
+            labels[name]['Instances'].append({
+                'BoundingBox': {'Width': right - left, 'Height': bottom - top, 'Left': left, 'Top': top},
+                'Confidence': conf
+            })
+
+        return {'Labels': list(labels.values()), 'Detector': self.name}
+
+class CascadeDetector(object):
+    '''Runs the local detector on every frame, and Rekognition only on frames where it finds a label of interest.
+
+    Other frames keep the local detector's labels, at no Rekognition cost. With an empty labels_of_interest,
+    any local detection is of interest.
+    '''
+
+    name = 'cascade'
+
+    def __init__(self, local_detector, remote_detector, labels_of_interest, min_conf):
+        self.local_detector = local_detector
+        self.remote_detector = remote_detector
+        self.labels_of_interest = set(label.upper() for label in labels_of_interest)
+        self.min_conf = min_conf
+
+    def is_of_interest(self, label):
+        return label['Confidence'] >= self.min_conf \
+            and (not self.labels_of_interest or label['Name'].upper() in self.labels_of_interest)
+
+    def detect(self, img_bytes):
+        response = self.local_detector.detect(img_bytes)
+
+        if any(self.is_of_interest(label) for label in response['Labels']):
+            #If Rekognition fails (e.g. throttling), keep the local labels rather than lose the frame
+            try:
+                return self.remote_detector.detect(img_bytes)
+            except Exception as e:
+                print("Rekognition failed, keeping the local detector's labels. Error: {}".format(e))
+
+        return response
+
+def make_detector(config, rekog_client):
+    '''Builds the detector selected by the "detector_backend" parameter: rekognition (default), opencv, or cascade.'''
+    backend = config.get("detector_backend", "rekognition")
+
+    if backend == "rekognition":
+        return RekognitionDetector(rekog_client, config["rekog_max_labels"], float(config["rekog_min_conf"]))
+
+    local_detector = OpenCVDetector(
+        config["detector_model_path"],
+        config.get("detector_model_config_path", ""),
+        config["detector_class_names"],
+        float(config.get("detector_min_conf", 50.0)),
+        input_size=int(config.get("detector_input_size", 300)),
+        input_scale=float(config.get("detector_input_scale", 1.0)),
+        input_mean=float(config.get("detector_input_mean", 0.0)),
+        input_swap_rb=config.get("detector_input_swap_rb", False))
+
+    if backend == "opencv":
+        return local_detector
+
+    if backend == "cascade":
+        return CascadeDetector(
+            local_detector,
+            RekognitionDetector(rekog_client, config["rekog_max_labels"], float(config["rekog_min_conf"])),
+            config.get("detector_cascade_labels", []),
+            float(config.get("detector_cascade_min_conf", 50.0)))
+
+    raise ValueError("Unknown detector backend '{}'.".format(backend))
@@ -6,6 +6,7 @@
 from __future__ import print_function
 import base64
 import datetime
+import io
 import time
 from decimal import Decimal
 import uuid
@@ -15,6 +16,20 @@ import boto3
 import pytz
 from pytz import timezone
 from copy import deepcopy
+import detectors
+import watchlist
+
+try:
+    from PIL import Image
+except ImportError:
+    #Pillow is optional. Without it, frames are stored without thumbnails.
+    Image = None
+
+try:
+    import tracker
+except ImportError:
+    #The object tracker requires NumPy, which is optional unless "tracker_enabled" is true.
+    tracker = None
 
 def load_config():
     '''Load configuration from file.'''
@@ -34,6 +49,70 @@ def convert_ts(ts, config):
 
     return localized_dt
 
+def label_bucket(label, ts):
+    '''Label index partition key: upper-cased label and UTC hour of processing. Frame Fetcher builds the same keys.'''
+    return '{}#{}'.format(label.upper(), time.strftime('%Y%m%d%H', time.gmtime(ts)))
+
+def rollup_buckets(ts):
+    '''Start timestamps of the minute and hour buckets that a frame is counted in.'''
+    ts = int(ts)
+    return (('m', ts - ts % 60), ('h', ts - ts % 3600))
+
+def load_tracker(track_state_table, camera_id, config):
+    '''Loads a camera's object tracker with the track state saved by the previous invocation.'''
+    response = track_state_table.get_item(Key={'camera_id': camera_id})
+
+    return tracker.CameraTracker.from_json(
+        camera_id,
+        response.get('Item', {}).get('state'),
+        min_iou=float(config.get("tracker_min_iou", 0.3)),
+        max_missed=int(config.get("tracker_max_missed", 2)),
+        max_gap_secs=float(config.get("tracker_max_gap_secs", 30)))
+
+def make_thumbnail(img_bytes, max_size, quality):
+    '''Downscales a JPEG frame to fit within max_size pixels. Returns JPEG bytes, or None if Pillow is unavailable.'''
+    if Image is None:
+        return None
+
+    img = Image.open(io.BytesIO(img_bytes))
+    #draft() lets the JPEG decoder downscale by a power of 2 while decoding, which is much cheaper than a full decode.
+    img.draft('RGB', (max_size, max_size))
+    img = img.convert('RGB')
+    img.thumbnail((max_size, max_size))
+
+    thumb_buff = io.BytesIO()
+    img.save(thumb_buff, format='JPEG', quality=quality, optimize=True)
+
+    return thumb_buff.getvalue()
+
+
+def shed_keep_every(lag_secs, shed_tiers):
+    '''Returns K, where only every Kth frame of a camera gets labels at this lag. 1 keeps all frames, 0 none.
+
+    shed_tiers is a list of [lag_secs, K] pairs. The tier with the highest lag threshold reached applies.
+    '''
+    keep_every = 1
+    for tier_lag_secs, tier_keep_every in sorted(shed_tiers):
+        if lag_secs >= tier_lag_secs:
+            keep_every = int(tier_keep_every)
+    return keep_every
+
+#Frames seen per camera by this container, for picking every Kth frame. Kept across warm invocations.
+shed_frame_counters = {}
+
+def print_shed_metrics(namespace, metrics):
+    '''Prints metrics in CloudWatch Embedded Metric Format. CloudWatch Logs extracts them as custom metrics.'''
+    units = {'Secs': 'Seconds', 'Frames': 'Count', 'Every': 'None'}
+
+    print(json.dumps(dict(metrics, _aws={
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': namespace,
+            'Dimensions': [[]],
+            'Metrics': [{'Name': name, 'Unit': next(unit for suffix, unit in units.items() if name.endswith(suffix))}
+                for name in metrics]
+        }]
+    })))
 
 def process_image(event, context):
 
@@ -48,17 +127,56 @@ def process_image(event, context):
 
     s3_bucket = config["s3_bucket"]
     s3_key_frames_root = config["s3_key_frames_root"]
+    s3_key_thumbnails_root = config.get("s3_key_thumbnails_root", "thumbnails/")
+
+    thumbnail_max_size = int(config.get("thumbnail_max_size", 320))
+    thumbnail_quality = int(config.get("thumbnail_quality", 70))
 
     ddb_table = dynamodb.Table(config["ddb_table"])
+    label_index_table = dynamodb.Table(config["ddb_label_index_table"])
+    rollup_table = dynamodb.Table(config["ddb_rollup_table"])
       
-    rekog_max_labels = config["rekog_max_labels"]
-    rekog_min_conf = float(config["rekog_min_conf"])
+    #Labels frames with Rekognition, a local CPU model, or both (see "detector_backend")
+    detector = detectors.make_detector(config, rekog_client)
 
-    label_watch_list = config["label_watch_list"]
-    label_watch_min_conf = float(config["label_watch_min_conf"])
+    watch_list = watchlist.WatchList.from_config(config)
     label_watch_phone_num = config.get("label_watch_phone_num", "")
     label_watch_sns_topic_arn = config.get("label_watch_sns_topic_arn", "")
 
+    #With tracking, alerts fire when a watched object arrives (and leaves), instead of on every frame it is in
+    tracker_enabled = config.get("tracker_enabled", False)
+    tracker_alert_on_end = config.get("tracker_alert_on_end", True)
+
+    #Rather than fail every batch (which Kinesis would retry until the records expire), run without tracking
+    if tracker_enabled and tracker is None:
+        print("The object tracker ('tracker_enabled') requires NumPy to be packaged with the function. Frames are not tracked.")
+        tracker_enabled = False
+
+    track_state_table = dynamodb.Table(config["ddb_track_state_table"]) if tracker_enabled else None
+
+    #Camera id -> tracker. Loaded on a camera's first frame in the batch, saved once after the batch.
+    trackers = {}
+
+    #Label index entries of the whole batch, written at once after all frames are stored
+    label_index_entries = []
+
+    #Label counters of the whole batch: (rollup_key, bucket_ts) -> [frame count, instance count]
+    rollup_counts = {}
+
+    #When the consumer falls behind, only every Kth frame of a camera gets labels, so that processing catches up
+    shed_enabled = config.get("shed_enabled", False)
+    shed_tiers = config.get("shed_tiers", [])
+    shed_store_skipped = config.get("shed_skipped_frames", "store") == "store"
+
+    shed_stats = {
+        'MaxArrivalLagSecs': 0.0,
+        'MaxCaptureLagSecs': 0.0,
+        'KeepEvery': 1,
+        'EnrichedFrames': 0,
+        'StoredUnlabeledFrames': 0,
+        'DroppedFrames': 0
+    }
+
     #Iterate on frames fetched from Kinesis
     for record in event['Records']:
 
@@ -68,6 +186,7 @@ def process_image(event, context):
         img_bytes = frame_package["ImageBytes"]
         approx_capture_ts = frame_package["ApproximateCaptureTime"]
         frame_count = frame_package["FrameCount"]
+        camera_id = frame_package.get("CameraId", "default")
         
         now_ts = time.time()
 
@@ -81,18 +200,60 @@ def process_image(event, context):
         day = now.strftime("%d")
         hour = now.strftime("%H")
 
-        try:
-            rekog_response = rekog_client.detect_labels(
-                Image={
-                    'Bytes': img_bytes
-                },
-                MaxLabels=rekog_max_labels,
-                MinConfidence=rekog_min_conf
-            )
-        except Exception as e:
-            #Log error and ignore frame. You might want to add that frame to a dead-letter queue.
-            print(e)
-            return
+        #Capture lag includes time spent in the producer, and depends on the capture host's clock (and on replayed
+        #frames keeping their original capture time). Shedding is driven by the time the record spent in Kinesis.
+        capture_lag_secs = now_ts - approx_capture_ts
+        arrival_ts = record['kinesis'].get('approximateArrivalTimestamp')
+        lag_secs = now_ts - float(arrival_ts) if arrival_ts else capture_lag_secs
+
+        shed_stats['MaxArrivalLagSecs'] = max(shed_stats['MaxArrivalLagSecs'], lag_secs)
+        shed_stats['MaxCaptureLagSecs'] = max(shed_stats['MaxCaptureLagSecs'], capture_lag_secs)
+
+        enrichment_pending = False
+        if shed_enabled:
+            keep_every = shed_keep_every(lag_secs, shed_tiers)
+            shed_stats['KeepEvery'] = keep_every
+
+            frame_num = shed_frame_counters.get(camera_id, 0)
+            shed_frame_counters[camera_id] = frame_num + 1
+
+            if keep_every != 1 and (keep_every == 0 or frame_num % keep_every != 0):
+                if not shed_store_skipped:
+                    shed_stats['DroppedFrames'] += 1
+                    continue
+
+                #Stored without labels. Flagged so that it can be enriched later.
+                enrichment_pending = True
+
+        if enrichment_pending:
+            rekog_response = {'Labels': []}
+            shed_stats['StoredUnlabeledFrames'] += 1
+        else:
+            try:
+                rekog_response = detector.detect(img_bytes)
+            except Exception as e:
+                #Log error and ignore frame. You might want to add that frame to a dead-letter queue.
+                print(e)
+                continue
+
+            shed_stats['EnrichedFrames'] += 1
+
+        #Associate this frame's objects with the camera's tracks. Tags labels and instances with a TrackId.
+        #Unlabeled frames are left out, so that tracks are not ended by frames that were never looked at.
+        track_events = []
+        frame_tracked = False
+        if tracker_enabled and not enrichment_pending:
+            if camera_id not in trackers:
+                trackers[camera_id] = load_tracker(track_state_table, camera_id, config)
+            cam_tracker = trackers[camera_id]
+            track_events = cam_tracker.update(rekog_response['Labels'], approx_capture_ts)
+
+            if track_events is None:
+                #Captured before a frame the camera's tracks already include (e.g. parallel replay ranges of one video)
+                print('Frame captured out of order. Its labels are stored without tracks, and raise no alerts.')
+                track_events = []
+            else:
+                frame_tracked = True
 
         #Iterate on rekognition labels. Enrich and prep them for storage in DynamoDB
         labels_on_watch_list = []
@@ -106,11 +267,24 @@ def process_image(event, context):
             print('{} .. conf %{:.2f}'.format(lbl, conf))
 
             #Check label watch list and trigger action
-            if (lbl.upper() in (label.upper() for label in label_watch_list)
-                and conf >= label_watch_min_conf):
+            if watch_list.matches(label):
 
                 label['OnWatchList'] = True
-                labels_on_watch_list.append(deepcopy(label))
+
+                if not tracker_enabled:
+                    labels_on_watch_list.append(deepcopy(label))
+                elif frame_tracked:
+                    #Alert once per track, on the first frame in which it qualifies
+                    track_ids = [instance['TrackId'] for instance in label['Instances']] or [label['TrackId']]
+                    new_track_ids = [track_id for track_id in track_ids if not cam_tracker.is_alerted(track_id)]
+
+                    if new_track_ids:
+                        for track_id in new_track_ids:
+                            cam_tracker.mark_alerted(track_id)
+
+                        watch_label = deepcopy(label)
+                        watch_label['TrackIds'] = new_track_ids
+                        labels_on_watch_list.append(watch_label)
 
             #Convert from float to decimal for DynamoDB
             label['Confidence'] = Decimal(conf)
@@ -122,17 +296,28 @@ def process_image(event, context):
                 instance['BoundingBox']['Top'] = Decimal(instance['BoundingBox']['Top'])
                 instance['Confidence'] = Decimal(instance['Confidence'])
 
+        #Tracks of watched objects that were alerted on, and have now left the frame
+        ended_on_watch_list = [track_event for track_event in track_events
+            if tracker_alert_on_end and track_event['event'] == 'end' and track_event['alerted']]
+
         #Send out notification(s), if needed
-        if len(labels_on_watch_list) > 0 \
+        if (len(labels_on_watch_list) > 0 or len(ended_on_watch_list) > 0) \
                 and (label_watch_phone_num or label_watch_sns_topic_arn):
 
             notification_txt = 'On {}...\n'.format(now.strftime('%x, %-I:%M %p %Z'))
 
             for label in labels_on_watch_list:
 
-                notification_txt += '- "{}" was detected with {}% confidence.\n'.format(
+                notification_txt += '- "{}" was detected with {}% confidence{}.\n'.format(
                     label['Name'],
-                    round(label['Confidence'], 2))
+                    round(label['Confidence'], 2),
+                    ' (track {})'.format(', '.join(label['TrackIds'])) if 'TrackIds' in label else '')
+
+            for track_event in ended_on_watch_list:
+
+                notification_txt += '- "{}" is no longer detected (track {}).\n'.format(
+                    track_event['label'],
+                    track_event['track_id'])
 
             print(notification_txt)
 
@@ -145,7 +330,8 @@ def process_image(event, context):
                     Message=json.dumps(
                         {
                             "message": notification_txt,
-                            "labels": labels_on_watch_list
+                            "labels": labels_on_watch_list,
+                            "ended_tracks": ended_on_watch_list
                         }
                     )
                 )
@@ -159,9 +345,30 @@ def process_image(event, context):
         s3_client.put_object(
             Bucket=s3_bucket,
             Key=s3_key,
-            Body=img_bytes
+            Body=img_bytes,
+            ContentType='image/jpeg'
         )
-        
+
+        #Store a downscaled copy of the frame for the Web UI
+        s3_thumbnail_key = None
+        if thumbnail_max_size > 0:
+            try:
+                thumb_bytes = make_thumbnail(img_bytes, thumbnail_max_size, thumbnail_quality)
+            except Exception as e:
+                #A bad thumbnail should not cost us the frame. Web UI falls back to the full-size image.
+                print(e)
+                thumb_bytes = None
+
+            if thumb_bytes:
+                s3_thumbnail_key = (s3_key_thumbnails_root + '{}/{}/{}/{}/{}.jpg').format(year, mon, day, hour, frame_id)
+
+                s3_client.put_object(
+                    Bucket=s3_bucket,
+                    Key=s3_thumbnail_key,
+                    Body=thumb_bytes,
+                    ContentType='image/jpeg'
+                )
+
         #Persist frame data in dynamodb
 
         item = {
@@ -174,11 +381,68 @@ def process_image(event, context):
                 if 'OrientationCorrection' in rekog_response else 'ROTATE_0',
             'processed_year_month' : year + mon, #To be used as a Hash Key for DynamoDB GSI
             's3_bucket' : s3_bucket,
-            's3_key' : s3_key
+            's3_key' : s3_key,
+            'camera_id' : camera_id
         }
 
+        if s3_thumbnail_key:
+            item['s3_thumbnail_key'] = s3_thumbnail_key
+
+        if enrichment_pending:
+            item['enrichment_pending'] = True
+            item['pending_year_month'] = year + mon #Hash Key of the sparse GSI of frames pending enrichment
+        else:
+            item['detector'] = rekog_response['Detector']
+
+        if track_events:
+            #Convert from float to decimal for DynamoDB
+            item['track_events'] = json.loads(json.dumps(track_events), parse_float=Decimal)
+
         ddb_table.put_item(Item=item)
 
+        #Index the frame under each of its labels. Confidence leads the sort key so queries can filter on it.
+        for label in rekog_response['Labels']:
+            label_index_entries.append({
+                'label_bucket': label_bucket(label['Name'], now_ts),
+                'conf_frame': '{:06.2f}#{}'.format(label['Confidence'], frame_id),
+                'label': label['Name'],
+                'confidence': label['Confidence'],
+                'frame_id': frame_id,
+                'processed_timestamp': processed_timestamp
+            })
+
+        #Count the frame's labels per camera and across all cameras ("*"), by capture time
+        for label in rekog_response['Labels']:
+            for cam in (camera_id, '*'):
+                for granularity, bucket_ts in rollup_buckets(approx_capture_ts):
+                    counts = rollup_counts.setdefault(
+                        ('{}#{}#{}'.format(label['Name'].upper(), cam, granularity), bucket_ts), [0, 0])
+                    counts[0] += 1
+                    counts[1] += len(label['Instances'])
+
+    with label_index_table.batch_writer(overwrite_by_pkeys=['label_bucket', 'conf_frame']) as batch:
+        for entry in label_index_entries:
+            batch.put_item(Item=entry)
+
+    #One atomic counter update per rollup bucket touched by this batch, rather than one per frame label
+    for (rollup_key, bucket_ts), (frames, instances) in rollup_counts.items():
+        rollup_table.update_item(
+            Key={'rollup_key': rollup_key, 'bucket_ts': bucket_ts},
+            UpdateExpression='ADD frame_count :f, instance_count :i',
+            ExpressionAttributeValues={':f': frames, ':i': instances}
+        )
+
+    #Persist track state for the next invocation
+    for camera_id, cam_tracker in trackers.items():
+        track_state_table.put_item(Item={
+            'camera_id': camera_id,
+            'state': cam_tracker.to_json(),
+            'updated_timestamp': Decimal(time.time())
+        })
+
+    #Lag and shed counts of the batch. KeepEvery is the sampling in effect at the end of the batch.
+    print_shed_metrics(config.get("shed_metrics_namespace", "VideoAnalyzer/ImageProcessor"), shed_stats)
+
     print('Successfully processed {} records.'.format(len(event['Records'])))
     return
 
@@ -0,0 +1,183 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+from __future__ import print_function
+import json
+import numpy as np
+
+# Labels returned without instances (e.g. scene-level labels) are tracked as a
+# single box covering the whole frame. Such a "presence track" starts when the
+# label appears and ends when it is gone.
+WHOLE_FRAME_BOX = (0.0, 0.0, 1.0, 1.0)
+
+def to_corners(bounding_box):
+    '''Converts a Rekognition BoundingBox to a (left, top, right, bottom) tuple.'''
+    left = float(bounding_box['Left'])
+    top = float(bounding_box['Top'])
+    return (left, top, left + float(bounding_box['Width']), top + float(bounding_box['Height']))
+
+def iou_matrix(boxes_a, boxes_b):
+    '''Intersection over union of every box in boxes_a (N x 4) with every box in boxes_b (M x 4). Returns an N x M array.'''
+    a = boxes_a[:, np.newaxis, :]
+    b = boxes_b[np.newaxis, :, :]
+
+    inter_w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = inter_w * inter_h
+
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - inter
+
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0.0)
+
+def greedy_match(iou, min_iou):
+    '''Pairs rows and columns of an IoU matrix, highest IoU first. Returns a list of (row, col).'''
+    iou = iou.copy()
+    matches = []
+
+    while iou.size:
+        row, col = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[row, col] < min_iou:
+            break
+        matches.append((int(row), int(col)))
+        iou[row, :] = -1
+        iou[:, col] = -1
+
+    return matches
+
+class CameraTracker(object):
+    '''Associates detections across consecutive frames of one camera and reports track start/end events.
+
+    State is a plain dict, so it can be persisted between invocations with to_json()/from_json().
+    Frames must come in capture order. A frame older than the latest one seen (e.g. from parallel replay
+    ranges of one video) is not tracked, so that tracks never move back in time.
+    '''
+
+    def __init__(self, camera_id, min_iou=0.3, max_missed=2, max_gap_secs=30.0, state=None):
+        self.camera_id = camera_id
+        self.min_iou = min_iou
+        self.max_missed = max_missed
+        self.max_gap_secs = max_gap_secs
+
+        state = state or {}
+        self.next_track_num = state.get('next_track_num', 1)
+        self.tracks = state.get('tracks', [])
+        #State saved before frame order was checked has no last_frame_ts
+        self.last_frame_ts = state.get('last_frame_ts', max([track['last_ts'] for track in self.tracks] or [None]))
+
+    def to_json(self):
+        return json.dumps({'next_track_num': self.next_track_num, 'tracks': self.tracks, 'last_frame_ts': self.last_frame_ts})
+
+    @classmethod
+    def from_json(cls, camera_id, state_json, **kwargs):
+        return cls(camera_id, state=json.loads(state_json) if state_json else None, **kwargs)
+
+    def _end(self, track, events):
+        events.append({
+            'event': 'end',
+            'track_id': track['track_id'],
+            'label': track['label'],
+            'start_ts': track['start_ts'],
+            'end_ts': track['last_ts'],
+            'alerted': track.get('alerted', False)
+        })
+
+    def update(self, labels, ts):
+        '''Updates tracks with the Rekognition labels of a new frame captured at ts.
+
+        Adds a "TrackId" to every instance (and to every label without instances). Returns the list of
+        track events, each a dict with "event" ("start" or "end"), "track_id", and "label". Returns None,
+        and tags nothing, if the frame is older than the latest frame seen.
+        '''
+        if self.last_frame_ts is not None and ts < self.last_frame_ts:
+            return None
+        self.last_frame_ts = ts
+
+        events = []
+
+        #Tracks not seen for too long are ended, whatever this frame contains
+        live_tracks = []
+        for track in self.tracks:
+            if ts - track['last_ts'] > self.max_gap_secs:
+                self._end(track, events)
+            else:
+                live_tracks.append(track)
+
+        #Detections of this frame: (label name, corners, confidence, dict to tag with the track id)
+        detections = []
+        for label in labels:
+            if label.get('Instances'):
+                for instance in label['Instances']:
+                    detections.append((label['Name'], to_corners(instance['BoundingBox']), float(instance['Confidence']), instance))
+            else:
+                detections.append((label['Name'], WHOLE_FRAME_BOX, float(label['Confidence']), label))
+
+        matched_tracks = set()
+        matched_detections = set()
+
+        if live_tracks and detections:
+            track_boxes = np.array([track['box'] for track in live_tracks], dtype=np.float64)
+            detection_boxes = np.array([detection[1] for detection in detections], dtype=np.float64)
+
+            #Only detections of the same label may continue a track
+            track_labels = np.array([track['label'] for track in live_tracks])
+            detection_labels = np.array([detection[0] for detection in detections])
+            same_label = track_labels[:, np.newaxis] == detection_labels[np.newaxis, :]
+
+            iou = np.where(same_label, iou_matrix(track_boxes, detection_boxes), 0.0)
+
+            for track_idx, detection_idx in greedy_match(iou, self.min_iou):
+                track = live_tracks[track_idx]
+                name, box, conf, target = detections[detection_idx]
+
+                track['box'] = list(box)
+                track['last_ts'] = ts
+                track['missed'] = 0
+                track['max_conf'] = max(track['max_conf'], conf)
+                target['TrackId'] = track['track_id']
+
+                matched_tracks.add(track_idx)
+                matched_detections.add(detection_idx)
+
+        self.tracks = []
+        for track_idx, track in enumerate(live_tracks):
+            if track_idx not in matched_tracks:
+                track['missed'] += 1
+                if track['missed'] > self.max_missed:
+                    self._end(track, events)
+                    continue
+            self.tracks.append(track)
+
+        for detection_idx, (name, box, conf, target) in enumerate(detections):
+            if detection_idx in matched_detections:
+                continue
+
+            track_id = '{}:{}'.format(self.camera_id, self.next_track_num)
+            self.next_track_num += 1
+
+            self.tracks.append({
+                'track_id': track_id,
+                'label': name,
+                'box': list(box),
+                'start_ts': ts,
+                'last_ts': ts,
+                'missed': 0,
+                'max_conf': conf
+            })
+            target['TrackId'] = track_id
+
+            events.append({'event': 'start', 'track_id': track_id, 'label': name, 'start_ts': ts})
+
+        return events
+
+    def mark_alerted(self, track_id):
+        '''Records that an alert was sent for a track, so that its end is also reported.'''
+        for track in self.tracks:
+            if track['track_id'] == track_id:
+                track['alerted'] = True
+
+    def is_alerted(self, track_id):
+        return any(track.get('alerted') for track in self.tracks if track['track_id'] == track_id)
@@ -0,0 +1,29 @@
+# Copyright 2017 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Amazon Software License (the "License"). You may not use this file except in compliance with the License. A copy of the License is located at
+#     http://aws.amazon.com/asl/
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
+
+class WatchList(object):
+    '''Label Watch List rules: a label is on the watch list if its name is listed (case-insensitively)
+    and its confidence reaches the minimum.
+
+    Used by Image Processor on fresh labels, and by analytics/reevaluate_watchlist.py on stored labels.
+    Confidence may be a float (from a detector) or a Decimal (from DynamoDB).
+    '''
+
+    def __init__(self, labels, min_conf):
+        self.labels = sorted(set(label.upper() for label in labels))
+        self.min_conf = float(min_conf)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["label_watch_list"], config["label_watch_min_conf"])
+
+    def to_dict(self):
+        return {'labels': self.labels, 'min_conf': self.min_conf}
+
+    def matches(self, label):
+        return label['Name'].upper() in self.labels and label['Confidence'] >= self.min_conf
+
+    def matching_labels(self, labels):
+        return [label for label in labels if self.matches(label)]